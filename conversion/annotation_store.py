@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from gen_ann_file import PubtatorAnnotation
+
+ARRAYS_NAME = 'arrays.npz'
+VOCAB_NAME = 'vocab.json'
+
+
+def intern(vocab, value):
+    code = vocab.get(value)
+    if code is None:
+        code = vocab[value] = len(vocab)
+    return code
+
+
+def store_params(offsets, entity_ids, **params):
+    """
+    Everything that the annotations of a store depend on, as saved with it. The entity ids are only kept as a hash.
+    """
+    entity_hash = hashlib.sha1('\n'.join(sorted(entity_ids)).encode()).hexdigest() if entity_ids is not None else None
+    return dict(params, offsets=str(offsets), entity_ids=entity_hash)
+
+
+class AnnotationStore:
+    """
+    Annotations of all documents as columns of codes into interned types, ids and mentions, sorted by PMID.
+    The annotations of the i-th PMID are at doc_starts[i]:doc_starts[i + 1].
+    """
+
+    def __init__(self, pmids, doc_starts, type_codes, id_codes, mention_codes, types, ids, mentions):
+        self.pmids = pmids
+        self.doc_starts = doc_starts
+        self.type_codes = type_codes
+        self.id_codes = id_codes
+        self.mention_codes = mention_codes
+        self.types = types
+        self.ids = ids
+        self.mentions = mentions
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Store of the annotation records (pmid, start, end, mention, type, id), text records are skipped
+        """
+        print("Loading annotations")
+        vocabs = {}, {}, {}
+        pmid_codes, type_codes, id_codes, mention_codes = array('q'), array('b'), array('i'), array('i')
+        for record in records:
+            if len(record) != 6: # text
+                continue
+            pmid, _, _, mention, type_, id_ = record
+            pmid_codes.append(int(pmid))
+            type_codes.append(intern(vocabs[0], type_))
+            id_codes.append(intern(vocabs[1], id_))
+            mention_codes.append(intern(vocabs[2], mention))
+
+        pmid_codes = np.asarray(pmid_codes, dtype=np.int64)
+        order = np.argsort(pmid_codes, kind='stable')
+        pmids, counts = np.unique(pmid_codes[order], return_counts=True)
+        doc_starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        types, ids, mentions = (list(vocab) for vocab in vocabs)
+
+        return cls(pmids, doc_starts, np.asarray(type_codes, dtype=np.int8)[order],
+                   np.asarray(id_codes, dtype=np.int32)[order], np.asarray(mention_codes, dtype=np.int32)[order],
+                   types, ids, mentions)
+
+    def save(self, path, params=None):
+        """
+        params (see store_params) are saved with the store, so that it is only reused for the same parameters
+        """
+        path = Path(path)
+        os.makedirs(path, exist_ok=True)
+        np.savez(path / ARRAYS_NAME, pmids=self.pmids, doc_starts=self.doc_starts, type_codes=self.type_codes,
+                 id_codes=self.id_codes, mention_codes=self.mention_codes)
+        with (path / VOCAB_NAME).open('w') as f:
+            json.dump({'types': self.types, 'ids': self.ids, 'mentions': self.mentions, 'params': params}, f)
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        arrays = np.load(path / ARRAYS_NAME)
+        with (path / VOCAB_NAME).open() as f:
+            vocab = json.load(f)
+
+        return cls(arrays['pmids'], arrays['doc_starts'], arrays['type_codes'], arrays['id_codes'],
+                   arrays['mention_codes'], vocab['types'], vocab['ids'], vocab['mentions'])
+
+    @staticmethod
+    def exists(path, params=None):
+        """
+        Whether a store was saved at path with the same params
+        """
+        path = Path(path) / VOCAB_NAME
+        if not path.exists():
+            return False
+        with path.open() as f:
+            saved_params = json.load(f).get('params')
+        if saved_params != params:
+            print(f"Annotation store {path.parent} was built with different parameters, rebuilding it")
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def _doc_index(self, pmid):
+        i = np.searchsorted(self.pmids, int(pmid))
+        if i < len(self.pmids) and self.pmids[i] == int(pmid):
+            return i
+        return None
+
+    def __contains__(self, pmid):
+        return self._doc_index(pmid) is not None
+
+    def __getitem__(self, pmid):
+        i = self._doc_index(pmid)
+        if i is None:
+            raise KeyError(pmid)
+        return [PubtatorAnnotation(self.types[t], self.ids[e], self.mentions[m]) for t, e, m in
+                zip(*(codes[self.doc_starts[i]:self.doc_starts[i + 1]].tolist()
+                      for codes in (self.type_codes, self.id_codes, self.mention_codes)))]
+
+    def items(self):
+        for pmid in self.pmids.tolist():
+            yield str(pmid), self[pmid]
+
+    def entity_docs(self):
+        """
+        Sorted PMIDs of the documents that mention each entity, keyed by (id, type)
+        """
+        doc_idx = np.repeat(np.arange(len(self.pmids), dtype=np.int64), np.diff(self.doc_starts))
+        entities = self.type_codes.astype(np.int64) * len(self.ids) + self.id_codes
+        # one entry per entity and document, sorted by entity and then by PMID
+        keys = np.unique(entities * len(self.pmids) + doc_idx)
+        entities, doc_idx = np.divmod(keys, len(self.pmids))
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(entities)) + 1]) if len(keys) else []
+        ends = np.append(starts[1:], len(keys))
+        result = {}
+        for start, end in zip(starts, ends):
+            type_code, id_code = divmod(int(entities[start]), len(self.ids))
+            result[(self.ids[id_code], self.types[type_code])] = self.pmids[doc_idx[start:end]]
+
+        return result
@@ -7,6 +7,7 @@ from tqdm import tqdm
 
 import pandas as pd
 from .util import geneid_to_uniprot
+from .id_cache import load_gene_expansion
 
 
 TYPE_MAPPING = {
@@ -73,8 +74,8 @@ def convert_to_sifnx(relations: pd.DataFrame, event_id_to_article: Dict[str, Lis
 
 
 if __name__ == '__main__':
-    with open('data/geneid2uniprot.json') as f:
-        geneid2uniprot = json.load(f)
+    # the same precomputed table that the PubTator conversion uses
+    geneid2uniprot = load_gene_expansion('data/geneid2uniprot.json')
     mg = MyGeneInfo()
     relations = pd.read_csv('data/EVEX_relations_9606.tab', sep='\t')
     event_id_to_article = defaultdict(list)
@@ -1,7 +1,6 @@
-import csv
 import json
 from bisect import bisect_right
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 from argparse import ArgumentParser
 from pathlib import Path
 import re
@@ -15,6 +14,7 @@ from tqdm import tqdm
 
 import logging
 
+from id_cache import PmcidLookup
 
 
 ANN_LINE_ESTIMATE = 1118483040
@@ -27,51 +27,11 @@ PubtatorAnnotation = namedtuple('PubtatorAnnotation',
 def is_text_line(line):
     return '|' in line[:50] and not '\t' in line[:50]
 
-def load_homologene(species=None):
-    if not species:
-        species = set()
-    
-    gene_mapping = defaultdict(set)
-    prev_cluster_id = None
-    human_genes = set()
-    other_genes = set()
-    with open("data/homologene.data") as f:
-        for line in f:
-            line = line.strip()
-            cluster_id, tax_id, gene_id = line.split('\t')[:3]
-
-            if prev_cluster_id and cluster_id != prev_cluster_id:
-                for other_gene in other_genes:
-                    gene_mapping[other_gene].update(human_genes)
-                human_genes = set()
-                other_genes = set()
-            
-            if tax_id == '9606':
-                human_genes.add(gene_id)
-            if tax_id in species:
-                other_genes.add(gene_id)
-            
-            prev_cluster_id = cluster_id
-
-    for other_gene in other_genes:
-        gene_mapping[other_gene].update(human_genes)
-    
-    return gene_mapping
-
-
-def load_annotations(lines):
-    print("Loading annotations")
-
-    anns = defaultdict(list)
-    for line in lines:
-        line = line.strip()
-        if is_text_line(line) or not line:
-            continue
-        pmid, _, _, mention, type_, id_ = line.split('\t')
-        anns[pmid].append(PubtatorAnnotation(type_, id_, mention))
-        
-    return anns
+def line_pmid(line):
+    return "".join(itertools.takewhile(lambda x: x not in {'\t', '|'}, line))
 
+def shard_of(pmid, n_workers):
+    return mmh3.hash(pmid) % n_workers
 
 
 def _is_supported_passage_type(passage_type):
@@ -219,7 +179,7 @@ class LocalPMCManager:
         return start, end
 
 
-def augment_offset_lines(line, types, mapping, homolog_mapping):
+def augment_offset_lines(line, types, expansion):
     if '|' in line[:50] or not line:
         yield line
     else:
@@ -230,50 +190,60 @@ def augment_offset_lines(line, types, mapping, homolog_mapping):
         if type_ != 'Gene':
             return
 
-        mapping = mapping['Gene']
+        for record in augment_offset_record(fields, expansion):
+            yield '\t'.join(record)
+
+
+def augment_offset_record(record, expansion):
+    """
+    The gene annotation (pmid, start, end, mention, type, id) once for every id in its expansion
+    """
+    pmid, start, end, mention, type_, id_ = record
+    for gene in expansion.get(id_, ()):
+        yield (pmid, start, end, mention, type_, gene)
+
 
-        extended_genes = set(mapping.get(id_, []))
-        for homologue in homolog_mapping[id_]:
-            extended_genes.update(mapping.get(homologue, []))
-        
-        for gene in extended_genes:
-            yield '\t'.join([pmid, start, end, mention, type_, gene])
+def get_source_gene_ids(entity_ids, expansion):
+    """
+    The gene ids whose annotations augment_offset_record maps to at least one of entity_ids
+    """
+    entity_ids = set(entity_ids)
+    return {id_ for id_, genes in expansion.items() if entity_ids.intersection(genes)}
 
 
-def get_augmented_offset_lines(lines, pmc_dir, types=None, test=False, homologue_species=None, mapping=None, worker=0, n_workers=1,
-                                relevant_pmids=None):
+def get_augmented_offset_lines(lines, pmc_dir, types=None, test=False, expansion=None, worker=0, n_workers=1,
+                                relevant_pmids=None, presharded=False):
+    """
+    expansion is the mapping of gene ids from id_cache.load_gene_expansion.
+    With presharded, lines only contain the documents of this worker (see shard_offsets.py) and are not filtered again
+    """
 
     logging.basicConfig(filename=f"{__file__}.{worker}.log", level=logging.ERROR)
 
     relevant_pmids = relevant_pmids or set()
-    homolog_mapping = load_homologene(homologue_species)
-    mapping = mapping or {}
-    pmid_to_pmcid = {}
+    expansion = expansion or {}
+    pmid_to_pmcid = PmcidLookup()
     pmc_manager = LocalPMCManager(pmc_dir)
-    with open('data/PMC-ids.csv') as f:
-        next(f)
-        for fields in csv.reader(f):
-            pmid_to_pmcid[fields[9]] = fields[8]
-
-        if relevant_pmids:
-            relevant_pmcids = set(pmid_to_pmcid[pmid] for pmid in relevant_pmids if pmid in pmid_to_pmcid)
-            logging.info(f"{len(relevant_pmids)} relevant PMIDs of which {len(relevant_pmcids)} have a PMCID")
-    for lino, line in tqdm(enumerate(lines), total=ANN_LINE_ESTIMATE):
+    if relevant_pmids:
+        relevant_pmcids = set(pmid_to_pmcid[pmid] for pmid in relevant_pmids if pmid in pmid_to_pmcid)
+        logging.info(f"{len(relevant_pmids)} relevant PMIDs of which {len(relevant_pmcids)} have a PMCID")
+    line_estimate = ANN_LINE_ESTIMATE // n_workers if presharded else ANN_LINE_ESTIMATE
+    for lino, line in tqdm(enumerate(lines), total=line_estimate):
         line = line.strip()
         if not line:
             continue
-        if test and lino > ANN_LINE_ESTIMATE//1000:
+        if test and lino > line_estimate//1000:
             break
 
-        pmid = "".join(itertools.takewhile(lambda x: x not in {'\t', '|'}, line))
+        pmid = line_pmid(line)
 
-        if mmh3.hash(pmid) % n_workers != worker:
+        if not presharded and shard_of(pmid, n_workers) != worker:
             continue
 
         if pmid in pmid_to_pmcid:
             pmcid = pmid_to_pmcid[pmid]
             for pmc_line in pmc_manager.get_lines(pmcid=pmcid, pmid=pmid, line=line):
-                yield from augment_offset_lines(line=pmc_line, types=types, mapping=mapping, homolog_mapping=homolog_mapping)
+                yield from augment_offset_lines(line=pmc_line, types=types, expansion=expansion)
         else:
-            yield from augment_offset_lines(line=line, types=types, mapping=mapping, homolog_mapping=homolog_mapping)
+            yield from augment_offset_lines(line=line, types=types, expansion=expansion)
 
@@ -6,7 +6,12 @@ from argparse import ArgumentParser
 
 from pairs import PairGetter
 
-from gen_ann_file import load_annotations, get_augmented_offset_lines
+from gen_ann_file import get_augmented_offset_lines
+from id_cache import load_gene_expansion
+from shard_offsets import shard_path
+from pmid_index import PmidIndex
+from pubtator_reader import get_augmented_offset_records
+from annotation_store import AnnotationStore, store_params
 from tax_ids import TAX_IDS
 
 TypedEntity = PairGetter.TypedEntity
@@ -60,7 +65,7 @@ def write_examples(getter: PairGetter, offset_lines, fname, train_pairs, dev_pai
             if args.test and i > 1000:
                 break
 
-            for pair in getter._pmid_to_entity_sets[doc.pmid]:
+            for pair in getter.get_entity_sets(doc.pmid):
                 if pair in train_pairs:
                     for triple in train_pairs[pair]:
                         examples = "\n".join(triple_to_examples(triple, getter, doc))
@@ -93,6 +98,14 @@ if __name__ == '__main__':
     parser.add_argument('--pmid_blacklist', default=None)
     parser.add_argument('--mapping', default=None)
     parser.add_argument('--species', default="")
+    parser.add_argument('--offsets', default='bioconcepts2pubtatorcentral.offset')
+    parser.add_argument('--presharded', action='store_true',
+                        help="Read the shard of this worker written by shard_offsets.py instead of the full offsets")
+    parser.add_argument('--pmid_index', action='store_true',
+                        help="Read only the relevant documents with the PMID index of the offsets (built on first use)")
+    parser.add_argument('--annotation_store', default=None, type=Path,
+                        help="Directory in which the annotations of this worker are saved after the first run and "
+                             "loaded from in later runs with the same offsets, pairs, mapping, species and worker")
 
     args = parser.parse_args()
 
@@ -144,27 +157,34 @@ if __name__ == '__main__':
 
     pairs = set(train_pairs) | set(dev_pairs) | set(test_pairs)
 
-    anns_path = 'bioconcepts2pubtatorcentral.offset'
+    anns_path = shard_path(args.offsets, args.worker, args.n_workers) if args.presharded else args.offsets
 
     species = [TAX_IDS[s] for s in args.species.split(',')]
 
-    mapping = {}
-    if args.mapping:
-        with open(args.mapping) as f:
-            mapping['Gene'] = json.load(f)
+    expansion = load_gene_expansion(args.mapping, species) if args.mapping else {}
+
+    entity_ids = {entity.id for pair in pairs for entity in pair}
+    params = store_params(anns_path, entity_ids, mapping=args.mapping, species=sorted(species),
+                          test=args.test, worker=args.worker, n_workers=args.n_workers,
+                          pmc_dir=str(args.pmc_dir))
+    if args.annotation_store and AnnotationStore.exists(args.annotation_store, params):
+        anns = AnnotationStore.load(args.annotation_store)
+    else:
+        with open(anns_path, 'rb') as f:
+            records = get_augmented_offset_records(f, pmc_dir=args.pmc_dir, types={'Gene'}, expansion=expansion,
+                                                   test=args.test, worker=args.worker, n_workers=args.n_workers,
+                                                   presharded=args.presharded, entity_ids=entity_ids)
+            anns = AnnotationStore.from_records(records)
+        if args.annotation_store:
+            anns.save(args.annotation_store, params)
+    getter = PairGetter(entity_sets=pairs, anns=anns)
 
     with open(anns_path) as f:
-        offset_lines = get_augmented_offset_lines(f, pmc_dir=args.pmc_dir, types={'Gene'}, mapping=mapping,
-                                                  homologue_species=species,
-                                                  test=args.test, worker=args.worker, n_workers=args.n_workers)
-        anns = load_annotations(offset_lines)
-        getter = PairGetter(entity_sets=pairs, anns=anns)
-
-    with open(anns_path) as f:
-        offset_lines = get_augmented_offset_lines(f, pmc_dir=args.pmc_dir, types={'Gene'}, mapping=mapping,
-                                                  homologue_species=species,
+        # seek to the documents that contain pairs instead of reading the whole file again
+        lines = PmidIndex(anns_path).read_lines(getter.relevant_pmids) if args.pmid_index else f
+        offset_lines = get_augmented_offset_lines(lines, pmc_dir=args.pmc_dir, types={'Gene'}, expansion=expansion,
                                                   test=args.test, worker=args.worker, n_workers=args.n_workers,
-                                                  relevant_pmids=getter.relevant_pmids)
+                                                  relevant_pmids=getter.relevant_pmids, presharded=args.presharded)
 
         dataset_dir = Path(str(args.input) + "_raw")
         os.makedirs(dataset_dir, exist_ok=True)
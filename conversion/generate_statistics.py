@@ -7,7 +7,12 @@ from argparse import ArgumentParser
 
 from pairs import PairGetter
 
-from gen_ann_file import get_augmented_offset_lines, load_annotations
+from gen_ann_file import get_augmented_offset_lines
+from id_cache import load_gene_expansion
+from shard_offsets import shard_path
+from pmid_index import PmidIndex
+from pubtator_reader import get_augmented_offset_records
+from annotation_store import AnnotationStore, store_params
 from tax_ids import TAX_IDS
 
 
@@ -24,7 +29,7 @@ def write_examples(getter: PairGetter, offset_lines, fname):
             if args.test and i > 1000:
                 break
 
-            for pair in getter._pmid_to_entity_sets[doc.pmid]:
+            for pair in getter.get_entity_sets(doc.pmid):
                 distance = getter.get_distance(pair, doc)
                 f.write(f"{pair[0].id},{pair[1].id}\t{doc.pmid}\t{distance}\n")
 
@@ -40,6 +45,13 @@ if __name__ == '__main__':
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--species', default="")
     parser.add_argument('--mapping', default=None)
+    parser.add_argument('--presharded', action='store_true',
+                        help="Read the shard of this worker written by shard_offsets.py instead of the full offsets")
+    parser.add_argument('--pmid_index', action='store_true',
+                        help="Read only the relevant documents with the PMID index of the offsets (built on first use)")
+    parser.add_argument('--annotation_store', default=None, type=Path,
+                        help="Directory in which the annotations of this worker are saved after the first run and "
+                             "loaded from in later runs with the same offsets, pairs, mapping, species and worker")
 
 
     args = parser.parse_args()
@@ -57,26 +69,36 @@ if __name__ == '__main__':
             pairs.add((TypedEntity(triple[0], 'Gene'), TypedEntity(triple[2], 'Gene')))
 
 
+    offsets_path = shard_path(args.offsets, args.worker, args.n_workers) if args.presharded else args.offsets
+
     species = [TAX_IDS[s] for s in args.species.split(',')]
 
-    mapping = {}
-    if args.mapping:
-        with open(args.mapping) as f:
-            mapping['Gene'] = json.load(f)
+    expansion = load_gene_expansion(args.mapping, species) if args.mapping else {}
 
-    with open(args.offsets) as f:
-        offset_lines = get_augmented_offset_lines(f, pmc_dir=args.pmc_dir, types={'Gene'}, mapping=mapping,
-                                                  homologue_species=species,
-                                                  test=args.test, worker=args.worker, n_workers=args.n_workers)
-        anns = load_annotations(offset_lines)
-        getter = PairGetter(entity_sets=pairs, anns=anns)
+    entity_ids = {entity.id for pair in pairs for entity in pair}
+    params = store_params(offsets_path, entity_ids, mapping=args.mapping, species=sorted(species),
+                          test=args.test, worker=args.worker, n_workers=args.n_workers,
+                          pmc_dir=str(args.pmc_dir))
+    if args.annotation_store and AnnotationStore.exists(args.annotation_store, params):
+        anns = AnnotationStore.load(args.annotation_store)
+    else:
+        with open(offsets_path, 'rb') as f:
+            records = get_augmented_offset_records(f, pmc_dir=args.pmc_dir, types={'Gene'}, expansion=expansion,
+                                                   test=args.test, worker=args.worker, n_workers=args.n_workers,
+                                                   presharded=args.presharded, entity_ids=entity_ids)
+            anns = AnnotationStore.from_records(records)
+        if args.annotation_store:
+            anns.save(args.annotation_store, params)
+    getter = PairGetter(entity_sets=pairs, anns=anns)
 
 
 
     os.makedirs(args.out.parent, exist_ok=True)
 
-    with open(args.offsets) as f:
-        offset_lines = get_augmented_offset_lines(f, pmc_dir=args.pmc_dir, types={'Gene'}, mapping=mapping,
-                                                  homologue_species=species,
-                                                  test=args.test, worker=args.worker, n_workers=args.n_workers)
+    with open(offsets_path) as f:
+        # seek to the documents that contain pairs instead of reading the whole file again
+        lines = PmidIndex(offsets_path).read_lines(getter.relevant_pmids) if args.pmid_index else f
+        offset_lines = get_augmented_offset_lines(lines, pmc_dir=args.pmc_dir, types={'Gene'}, expansion=expansion,
+                                                  test=args.test, worker=args.worker, n_workers=args.n_workers,
+                                                  presharded=args.presharded)
         write_examples(getter=getter, offset_lines=offset_lines, fname=str(args.out) + f'.{args.worker}')
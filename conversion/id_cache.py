@@ -0,0 +1,169 @@
+import csv
+import json
+import os
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+HOMOLOGENE_PATH = 'data/homologene.data'
+PMC_IDS_PATH = 'data/PMC-ids.csv'
+HUMAN_TAX_ID = 9606
+
+
+def cache_dir(source):
+    return Path(f"{source}.cache")
+
+
+def load_cached_arrays(source, build):
+    """
+    The arrays (a dict of name -> array) that build computes from the file source, cached as .npy files next to
+    source on first use and afterwards memory-mapped read-only, so that concurrent workers share the pages
+    """
+    path = cache_dir(source)
+    if not path.exists() or path.stat().st_mtime < os.stat(source).st_mtime:
+        arrays = build(source)
+        # several workers may build the cache at the same time. Each build goes into its own directory that is never
+        # changed or deleted afterwards, and the cache path is a symlink to the latest one that is swapped atomically.
+        version_dir = Path(tempfile.mkdtemp(prefix=f"{path.name}.", dir=path.parent))
+        os.chmod(version_dir, 0o755)
+        for name, array in arrays.items():
+            np.save(version_dir / f'{name}.npy', array)
+        link = version_dir.with_name(f"{version_dir.name}.link")
+        os.symlink(version_dir.name, link)
+        try:
+            os.replace(link, path)
+        except OSError:
+            # path is not a symlink (e.g. a directory from an older version), use this build without publishing it
+            os.remove(link)
+            path = version_dir
+
+    # resolved once, so that all arrays come from the same build even if another worker swaps the symlink meanwhile
+    path = path.resolve()
+    return {p.stem: np.load(p, mmap_mode='r') for p in path.glob('*.npy')}
+
+
+def _build_homologene(source):
+    columns = [], [], []
+    with open(source) as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            for column, field in zip(columns, fields[:3]):
+                column.append(int(field))
+
+    return {name: np.array(column, dtype=np.int64)
+            for name, column in zip(['cluster_ids', 'tax_ids', 'gene_ids'], columns)}
+
+
+def load_homologene_table(path=HOMOLOGENE_PATH):
+    return load_cached_arrays(path, _build_homologene)
+
+
+def homologene_rows(path=HOMOLOGENE_PATH):
+    """
+    (cluster id, tax id, gene id) of every line of homologene.data as strings, without parsing the file
+    """
+    table = load_homologene_table(path)
+    return zip(*(map(str, table[name].tolist()) for name in ['cluster_ids', 'tax_ids', 'gene_ids']))
+
+
+def load_homologene(species=None, path=HOMOLOGENE_PATH):
+    """
+    The human homologues of each gene of species
+    """
+    table = load_homologene_table(path)
+    cluster_ids, tax_ids, gene_ids = table['cluster_ids'], table['tax_ids'], table['gene_ids']
+    is_human = tax_ids == HUMAN_TAX_ID
+    is_other = np.isin(tax_ids, [int(s) for s in species or []])
+
+    human_genes = defaultdict(set)
+    for cluster_id, gene_id in zip(cluster_ids[is_human].tolist(), gene_ids[is_human].tolist()):
+        human_genes[cluster_id].add(str(gene_id))
+    gene_mapping = defaultdict(set)
+    for cluster_id, gene_id in zip(cluster_ids[is_other].tolist(), gene_ids[is_other].tolist()):
+        gene_mapping[str(gene_id)].update(human_genes[cluster_id])
+
+    return gene_mapping
+
+
+def expand_gene_mapping(mapping, homolog_mapping):
+    expansion = {}
+    for id_ in set(mapping) | set(homolog_mapping):
+        genes = set(mapping.get(id_, []))
+        for homologue in homolog_mapping.get(id_, ()):
+            genes.update(mapping.get(homologue, []))
+        if genes:
+            expansion[id_] = sorted(genes)
+
+    return expansion
+
+
+def load_gene_expansion(mapping_path, species=None):
+    """
+    Mapping from each gene id to the mapped ids of the gene and of its human homologues (for genes of species), built
+    once per mapping file and species and stored next to the mapping file
+    """
+    species = sorted(species or [])
+    path = Path(f"{mapping_path}.expanded.{'-'.join(species) or 'human'}.json")
+    # without species there are no homologues, and homologene.data is not needed at all
+    sources = (mapping_path, HOMOLOGENE_PATH) if species else (mapping_path,)
+    if path.exists() and all(path.stat().st_mtime >= os.stat(source).st_mtime for source in sources):
+        with path.open() as f:
+            return json.load(f)
+
+    with open(mapping_path) as f:
+        mapping = json.load(f)
+    expansion = expand_gene_mapping(mapping, load_homologene(species) if species else {})
+    # several workers may build the table at the same time
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(expansion, f)
+    os.replace(tmp_path, path)
+
+    return expansion
+
+
+def _build_pmc_ids(source):
+    pmids, pmcids = [], []
+    with open(source) as f:
+        next(f)
+        for fields in csv.reader(f):
+            if fields[9].isdigit() and fields[8].startswith('PMC'):
+                pmids.append(int(fields[9]))
+                pmcids.append(int(fields[8][3:]))
+    pmids = np.array(pmids, dtype=np.int64)
+    order = np.argsort(pmids, kind='stable')
+
+    return {'pmids': pmids[order], 'pmcids': np.array(pmcids, dtype=np.int64)[order]}
+
+
+class PmcidLookup:
+    """
+    Read-only mapping from PMID to PMCID (both as strings) backed by memory-mapped sorted arrays
+    """
+
+    def __init__(self, path=PMC_IDS_PATH):
+        arrays = load_cached_arrays(path, _build_pmc_ids)
+        self.pmids = arrays['pmids']
+        self.pmcids = arrays['pmcids']
+
+    def get(self, pmid, default=None):
+        if not pmid.isdigit():
+            return default
+        i = np.searchsorted(self.pmids, int(pmid))
+        if i < len(self.pmids) and self.pmids[i] == int(pmid):
+            return f"PMC{self.pmcids[i]}"
+        return default
+
+    def __contains__(self, pmid):
+        return self.get(pmid) is not None
+
+    def __getitem__(self, pmid):
+        pmcid = self.get(pmid)
+        if pmcid is None:
+            raise KeyError(pmid)
+        return pmcid
+
+    def __len__(self):
+        return len(self.pmids)
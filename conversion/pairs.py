@@ -2,7 +2,7 @@ import itertools
 import logging
 import string
 from bisect import bisect_right, bisect_left
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 from dataclasses import dataclass
 from itertools import takewhile
 from typing import List, Optional, Set, Dict, Any, Tuple
@@ -92,34 +92,53 @@ class PairGetter:
     TypedEntity = namedtuple('TypedEntity', 'id type')
 
     def __init__(self, entity_sets, anns):
+        """
+        anns is an annotation_store.AnnotationStore
+        """
         self.anns = anns
-        self.entity_sets = entity_sets
-        self._entity_sets_to_pmids = self.get_entity_sets_to_docs(entity_sets)
-        self._pmid_to_entity_sets = defaultdict(set)
-        for entity_set, docs in self._entity_sets_to_pmids.items():
-            for doc in docs:
-                self._pmid_to_entity_sets[doc].add(entity_set)
-        
+        self.entity_sets = list(entity_sets)
+        self._entity_sets_to_pmids = self.get_entity_sets_to_docs(self.entity_sets)
+
+        # inverted index from PMID to entity sets: the indices of the entity sets of the i-th PMID of _doc_pmids are
+        # _doc_entity_sets[_doc_starts[i]:_doc_starts[i + 1]]
+        pmids = [self._entity_sets_to_pmids[entity_set] for entity_set in self.entity_sets]
+        entity_set_idx = np.repeat(np.arange(len(pmids)), [len(p) for p in pmids])
+        pmids = np.concatenate(pmids) if pmids else np.array([], dtype=np.int64)
+        order = np.argsort(pmids, kind='stable')
+        self._doc_pmids, counts = np.unique(pmids[order], return_counts=True)
+        self._doc_starts = np.concatenate([[0], np.cumsum(counts)])
+        self._doc_entity_sets = entity_set_idx[order]
+        self._relevant_pmids = {str(pmid) for pmid in self._doc_pmids.tolist()}
+
     def get_entity_sets_to_docs(self, entity_sets):
+        """
+        Sorted PMIDs of the documents that mention all entities of each entity set
+        """
         print("Generating pair to document mapping")
-        entity_to_doc = defaultdict(set)
+        entity_to_pmids = self.anns.entity_docs()
+        no_docs = np.array([], dtype=np.int64)
         entity_sets_to_doc = {}
 
-        for pmid, doc_anns in tqdm(self.anns.items()):
-            for ann in doc_anns:
-                entity_to_doc[self.TypedEntity(ann.id, ann.type)].add(pmid)
-
         for entity_set in tqdm(entity_sets):
-            entity_sets_to_doc[entity_set] = entity_to_doc[entity_set[0]]
+            docs = entity_to_pmids.get(entity_set[0], no_docs)
             for entity in entity_set[1:]:
-                # cannot use &= here, because it will alter entity_to_doc[entity_set[0]] and lead to many hours of debugging :(
-                entity_sets_to_doc[entity_set] = entity_to_doc[entity] & entity_sets_to_doc[entity_set]
+                docs = np.intersect1d(docs, entity_to_pmids.get(entity, no_docs), assume_unique=True)
+            entity_sets_to_doc[entity_set] = docs
 
         return entity_sets_to_doc
 
+    def get_entity_sets(self, pmid):
+        """
+        The entity sets that all occur in the document
+        """
+        i = np.searchsorted(self._doc_pmids, int(pmid))
+        if i == len(self._doc_pmids) or self._doc_pmids[i] != int(pmid):
+            return set()
+        return {self.entity_sets[j] for j in self._doc_entity_sets[self._doc_starts[i]:self._doc_starts[i + 1]]}
+
     @property
     def relevant_pmids(self):
-        return set(self._pmid_to_entity_sets)
+        return set(self._relevant_pmids)
 
     def get_relevant_docs(self, offset_lines) -> Dict[str, Document]:
         print("Extracting documents")
@@ -135,7 +154,7 @@ class PairGetter:
                 yield Document.from_string(doc_lines)
                 doc_lines = []
 
-            if pmid in self._pmid_to_entity_sets:
+            if pmid in self._relevant_pmids:
                 doc_lines.append(line.strip())
                 active_pmid = pmid
         if doc_lines:
@@ -0,0 +1,99 @@
+import os
+import re
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from gen_ann_file import ANN_LINE_ESTIMATE
+
+READ_BATCH_SIZE = 1024
+PMID_PATTERN = re.compile(rb'(\d+)[\t|]')
+
+
+def index_path(offsets):
+    return Path(f"{offsets}.pmid_index.npz")
+
+
+def build_pmid_index(offsets):
+    """
+    Byte offset and length of every document in a PubTator offset file (or shard), in a single pass
+    """
+    pmids, starts, lengths = [], [], []
+    active_pmid = None
+    position = 0
+    with open(offsets, 'rb') as f:
+        for line in tqdm(f, total=ANN_LINE_ESTIMATE, desc="Indexing PMIDs"):
+            match = PMID_PATTERN.match(line)
+            if match:
+                pmid = match.group(1)
+                if pmid != active_pmid:
+                    pmids.append(int(pmid))
+                    starts.append(position)
+                    lengths.append(0)
+                    active_pmid = pmid
+                lengths[-1] = position + len(line) - starts[-1]
+            position += len(line)
+
+    pmids = np.array(pmids, dtype=np.int64)
+    order = np.argsort(pmids, kind='stable')
+    np.savez(index_path(offsets), pmids=pmids[order], starts=np.array(starts, dtype=np.int64)[order],
+             lengths=np.array(lengths, dtype=np.int64)[order])
+
+
+class PmidIndex:
+    """
+    Random access to the documents of a PubTator offset file by PMID
+    """
+
+    def __init__(self, offsets):
+        self.offsets = offsets
+        path = index_path(offsets)
+        if not path.exists() or path.stat().st_mtime < os.stat(offsets).st_mtime:
+            build_pmid_index(offsets)
+        index = np.load(path)
+        self.pmids = index['pmids']
+        self.starts = index['starts']
+        self.lengths = index['lengths']
+
+    def ranges(self, pmids):
+        """
+        (start, length) of all documents of pmids in file order
+        """
+        is_relevant = np.isin(self.pmids, np.array([int(p) for p in pmids], dtype=np.int64))
+        order = np.argsort(self.starts[is_relevant])
+
+        return list(zip(self.starts[is_relevant][order].tolist(), self.lengths[is_relevant][order].tolist()))
+
+    def read_lines(self, pmids, n_threads=8):
+        """
+        Lines of the documents of pmids in file order, read with parallel positioned reads
+        """
+        ranges = self.ranges(pmids)
+        fd = os.open(self.offsets, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(n_threads) as executor:
+                for i in range(0, len(ranges), READ_BATCH_SIZE):
+                    batch = ranges[i:i + READ_BATCH_SIZE]
+                    for block in executor.map(lambda r: os.pread(fd, r[1], r[0]), batch):
+                        # only split at newlines like iterating over the file, str.splitlines also splits at
+                        # characters such as \x85 or \x0c that occur in the text
+                        *lines, last = block.split(b'\n')
+                        for line in lines:
+                            yield line.decode() + '\n'
+                        if last: # the last line of the file without a newline
+                            yield last.decode()
+        finally:
+            os.close(fd)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Build the PMID index of a PubTator offset file or of each of its shards")
+    parser.add_argument('offsets', nargs='+', type=Path)
+
+    args = parser.parse_args()
+
+    for offsets in args.offsets:
+        build_pmid_index(offsets)
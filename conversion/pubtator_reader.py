@@ -0,0 +1,112 @@
+import logging
+import os
+import re
+
+from tqdm import tqdm
+
+from gen_ann_file import ANN_LINE_ESTIMATE, LocalPMCManager, augment_offset_record, get_source_gene_ids, shard_of
+from id_cache import PmcidLookup
+
+BLOCK_SIZE = 64 << 20
+
+
+def record_pattern(types, text=True):
+    """
+    One match per line to keep: text lines (pmid|type|text) and annotation lines (pmid, start, end, mention, type, id)
+    of the given entity types. All other lines are skipped by the regex engine without being seen by Python.
+    """
+    types = b'|'.join(re.escape(t.encode()) for t in sorted(types))
+    annotation = rb'\t\d+\t\d+\t[^\t\n]*\t(?:' + types + rb')\t[^\t\n]*?'
+    if text:
+        return re.compile(rb'^(\d+)(\|[^|\n]*\|[^\n]*?|' + annotation + rb')\r?$', re.M)
+    return re.compile(rb'^(\d+)(' + annotation + rb')\r?$', re.M)
+
+
+def read_blocks(f, block_size=BLOCK_SIZE):
+    # blocks of complete lines
+    rest = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+
+
+def to_record(line):
+    if '|' in line[:50] and '\t' not in line[:50]:
+        return tuple(line.split('|', 2))
+    return tuple(line.split('\t'))
+
+
+def read_records(f, types=('Gene',), text=True, worker=0, n_workers=1, presharded=False, ids=None):
+    """
+    Records of a PubTator offset file opened in binary mode, i.e. text lines as (pmid, passage type, text) and
+    annotation lines of the given types as (pmid, start, end, mention, type, id). Lines are matched and filtered
+    per block on bytes and only decoded when they are kept, which is several times faster than parsing them one by one.
+    Without presharded, only the documents of this worker are read. With ids, only annotations of these ids are kept.
+    """
+    ids = {id_.encode() for id_ in ids} if ids is not None else None
+    pattern = record_pattern(types, text)
+    active_pmid = None
+    is_relevant = True
+    size = os.fstat(f.fileno()).st_size
+    with tqdm(total=size, unit='B', unit_scale=True, desc="Reading annotations") as pbar:
+        for block in read_blocks(f):
+            pbar.update(len(block))
+            for match in pattern.finditer(block):
+                pmid = match.group(1)
+                if pmid != active_pmid:
+                    active_pmid = pmid
+                    # documents are contiguous, so that each one is only hashed once
+                    is_relevant = presharded or shard_of(pmid, n_workers) == worker
+                if not is_relevant:
+                    continue
+                line = match.group(0)
+                is_annotation = match.group(2)[:1] == b'\t'
+                if ids is not None and is_annotation and line[line.rfind(b'\t') + 1:].rstrip(b'\r') not in ids:
+                    continue
+                yield to_record(line.decode().rstrip('\r'))
+
+
+def get_augmented_offset_records(f, pmc_dir, types=('Gene',), test=False, expansion=None, worker=0, n_workers=1,
+                                 presharded=False, text=False, entity_ids=None):
+    """
+    Equivalent of gen_ann_file.get_augmented_offset_lines for a file opened in binary mode that yields records
+    instead of lines. Text records are produced with text, and for the documents whose text is taken from PMC.
+    With entity_ids, annotations that cannot be mapped to any of them are dropped while reading.
+    """
+    logging.basicConfig(filename=f"{__file__}.{worker}.log", level=logging.ERROR)
+
+    expansion = expansion or {}
+    pmid_to_pmcid = PmcidLookup()
+    pmc_manager = LocalPMCManager(pmc_dir)
+    source_ids = get_source_gene_ids(entity_ids, expansion) if entity_ids is not None else None
+    records = read_records(f, types=types, text=text, worker=worker, n_workers=n_workers, presharded=presharded,
+                           ids=source_ids)
+    active_pmid = pmcid = None
+    for i, record in enumerate(records):
+        if test and i > ANN_LINE_ESTIMATE // 1000:
+            break
+
+        pmid = record[0]
+        if pmid != active_pmid:
+            # one lookup per document
+            active_pmid, pmcid = pmid, pmid_to_pmcid.get(pmid)
+        if pmcid:
+            line = ('|' if len(record) == 3 else '\t').join(record)
+            for pmc_line in pmc_manager.get_lines(pmcid=pmcid, pmid=pmid, line=line):
+                pmc_record = to_record(pmc_line.strip())
+                if len(pmc_record) == 3:
+                    yield pmc_record
+                elif len(pmc_record) == 6 and pmc_record[4] in types:
+                    yield from augment_offset_record(pmc_record, expansion)
+        elif len(record) == 3:
+            yield record
+        else:
+            yield from augment_offset_record(record, expansion)
@@ -0,0 +1,54 @@
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+
+from tqdm import tqdm
+
+from gen_ann_file import ANN_LINE_ESTIMATE, line_pmid, shard_of
+
+
+def shard_path(offsets, worker, n_workers):
+    return Path(f"{offsets}.shards{n_workers}") / f"{worker:04d}.offset"
+
+
+def shard_offsets(offsets, n_workers):
+    """
+    Split the PubTator offset file into one file per worker in a single pass, with the same assignment of documents
+    to workers that get_augmented_offset_lines uses for the unsharded file. All lines of a document end up in the same
+    shard and keep their order.
+    """
+    shard_dir = shard_path(offsets, 0, n_workers).parent
+    os.makedirs(shard_dir, exist_ok=True)
+    tmp_paths = [shard_path(offsets, worker, n_workers).with_suffix('.tmp') for worker in range(n_workers)]
+    shards = [open(path, 'w', buffering=1 << 20) for path in tmp_paths]
+    try:
+        active_pmid = None
+        shard = None
+        with open(offsets) as f:
+            for line in tqdm(f, total=ANN_LINE_ESTIMATE):
+                if not line.strip():
+                    continue
+                pmid = line_pmid(line)
+                if pmid != active_pmid:
+                    active_pmid = pmid
+                    shard = shards[shard_of(pmid, n_workers)]
+                shard.write(line)
+    finally:
+        for shard in shards:
+            shard.close()
+
+    # renamed only after the complete pass, so that a shard directory never contains partial shards
+    for worker, path in enumerate(tmp_paths):
+        os.replace(path, shard_path(offsets, worker, n_workers))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Split bioconcepts2pubtatorcentral.offset by PMID into one file per worker, "
+                                        "which generate_comb_dist_data.py and generate_statistics.py read with "
+                                        "--presharded")
+    parser.add_argument('offsets', type=Path)
+    parser.add_argument('--n_workers', required=True, type=int)
+
+    args = parser.parse_args()
+
+    shard_offsets(args.offsets, args.n_workers)
@@ -6,6 +6,8 @@ import re
 import requests
 from networkx.utils import UnionFind
 
+from .id_cache import homologene_rows
+
 
 def geneid_to_uniprot(symbol, mg):
     try:
@@ -96,18 +98,15 @@ def load_homologene_uf(species=None, gene_conversion=None):
     prev_cluster_id = None
     cluster = set()
     uf = UnionFind()
-    with open(os.path.join(datadir, "homologene.data")) as f:
-        for line in f:
-            line = line.strip()
-            cluster_id, tax_id, gene_id = line.split('\t')[:3]
-            if gene_id in gene_conversion and tax_id in species:
-                cluster.update(gene_conversion[gene_id])
-            if prev_cluster_id and cluster_id != prev_cluster_id:
-                if cluster:
-                    uf.union(*cluster)
-                cluster = set()
-
-            prev_cluster_id = cluster_id
+    for cluster_id, tax_id, gene_id in homologene_rows(os.path.join(datadir, "homologene.data")):
+        if gene_id in gene_conversion and tax_id in species:
+            cluster.update(gene_conversion[gene_id])
+        if prev_cluster_id and cluster_id != prev_cluster_id:
+            if cluster:
+                uf.union(*cluster)
+            cluster = set()
+
+        prev_cluster_id = cluster_id
 
     return uf
 
@@ -120,28 +119,24 @@ def load_homologene(species=None, gene_conversion=None):
     prev_cluster_id = None
     human_genes = set()
     other_genes = set()
-    with open(os.path.join(datadir, "homologene.data")) as f:
-        for line in f:
-            line = line.strip()
-            cluster_id, tax_id, gene_id = line.split('\t')[:3]
-
-            if prev_cluster_id and cluster_id != prev_cluster_id:
-                if gene_conversion:
-                    other_genes = convert_genes(other_genes, gene_conversion)
-                    human_genes = convert_genes(human_genes, gene_conversion)
+    for cluster_id, tax_id, gene_id in homologene_rows(os.path.join(datadir, "homologene.data")):
+        if prev_cluster_id and cluster_id != prev_cluster_id:
+            if gene_conversion:
+                other_genes = convert_genes(other_genes, gene_conversion)
+                human_genes = convert_genes(human_genes, gene_conversion)
 
-                for other_gene in other_genes:
-                    gene_mapping[other_gene].update(human_genes)
+            for other_gene in other_genes:
+                gene_mapping[other_gene].update(human_genes)
 
-                human_genes = set()
-                other_genes = set()
+            human_genes = set()
+            other_genes = set()
 
-            if tax_id == '9606':
-                human_genes.add(gene_id)
-            if tax_id in species:
-                other_genes.add(gene_id)
+        if tax_id == '9606':
+            human_genes.add(gene_id)
+        if tax_id in species:
+            other_genes.add(gene_id)
 
-            prev_cluster_id = cluster_id
+        prev_cluster_id = cluster_id
 
     for other_gene in other_genes:
         gene_mapping[other_gene].update(human_genes)
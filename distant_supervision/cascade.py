@@ -0,0 +1,141 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+from sklearn.metrics import average_precision_score
+
+from .dataset import DistantBertDataset
+from .predict_pedl import predict, load_model
+
+
+def load_prefilter_scores(path):
+    """
+    Pair scores from the predictions of comb_dist_direct_relex (`allennlp predict ... --predictor relex`).
+    A pair is scored by its most probable relation.
+    """
+    scores = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            prediction = json.loads(line)
+            e1, e2 = prediction['entities']
+            probs = [p for _, p in prediction['labels']]
+            scores[f"{e1},{e2}"] = max(probs) if probs else 0.0
+
+    return scores
+
+
+def pair_scores(dataset, scores):
+    # pairs that comb-dist did not score are always passed on to PEDL
+    return np.array([scores.get(pair, np.inf) for pair in dataset.pairs])
+
+
+def calibrate_threshold(scores, is_positive, target_recall):
+    """
+    Largest threshold such that at least target_recall of the positive pairs score >= threshold.
+    """
+    positive_scores = np.sort(scores[is_positive])[::-1]
+    if len(positive_scores) == 0:
+        return -np.inf
+    n_keep = int(np.ceil(target_recall * len(positive_scores)))
+
+    return positive_scores[max(n_keep - 1, 0)]
+
+
+def top_fraction_threshold(scores, fraction):
+    n_keep = int(np.ceil(fraction * len(scores)))
+    if n_keep == 0:
+        return np.inf
+
+    return np.sort(scores)[::-1][n_keep - 1]
+
+
+def cascade_predict(dataset, model, scores, threshold, data=None, device='cpu'):
+    indices = [int(i) for i in np.flatnonzero(scores >= threshold)]
+    for idx, (prediction, ap) in zip(indices, predict(dataset, model, data=data, device=device, indices=indices)):
+        yield idx, prediction
+
+
+def recall_report(dataset, model, scores, threshold, device='cpu'):
+    """
+    Compare cascaded to full PEDL scoring on a labeled data set. Pairs rejected by the prefilter get score 0.
+    """
+    y_true = dataset.labels > 0
+    full_pred = np.zeros(y_true.shape)
+    for idx, (prediction, _) in enumerate(predict(dataset, model, device=device)):
+        full_pred[idx] = [score for _, score in prediction['labels']]
+
+    cascade_pred = np.zeros(y_true.shape)
+    passed = scores >= threshold
+    cascade_pred[passed] = full_pred[passed]
+
+    is_positive = y_true.any(axis=1)
+    token_counts = dataset.token_counts()
+    return {
+        'threshold': float(threshold),
+        'passed_pairs': int(passed.sum()),
+        'total_pairs': len(passed),
+        'skipped_token_fraction': float(token_counts[~passed].sum() / token_counts.sum()),
+        'positive_pair_recall': float(passed[is_positive].mean()) if is_positive.any() else None,
+        'full_ap': average_precision_score(y_true, full_pred, average='micro'),
+        'cascade_ap': average_precision_score(y_true, cascade_pred, average='micro'),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', type=Path)
+    parser.add_argument('output', type=Path)
+    parser.add_argument('--model_path', required=True, type=Path)
+    parser.add_argument('--data', required=True, type=Path)
+    parser.add_argument('--prefilter_preds', required=True, type=Path,
+                        help="comb-dist predictions for input")
+    parser.add_argument('--dev', type=Path, default=None,
+                        help="Labeled HDF5 data set on which the threshold is calibrated and the recall loss is reported")
+    parser.add_argument('--dev_prefilter_preds', type=Path, default=None,
+                        help="comb-dist predictions for --dev")
+    parser.add_argument('--target_recall', type=float, default=0.95,
+                        help="Fraction of positive dev pairs that have to pass the prefilter")
+    parser.add_argument('--top_fraction', type=float, default=None,
+                        help="Instead of calibrating on --dev, pass this fraction of the highest scoring pairs")
+    parser.add_argument('--device', default='cpu')
+
+    args = parser.parse_args()
+
+    if args.top_fraction is None and not (args.dev and args.dev_prefilter_preds):
+        parser.error("Calibrating the threshold requires --dev and --dev_prefilter_preds (or use --top_fraction)")
+
+    model = load_model(args.model_path)
+    model.to(args.device)
+
+    dataset = DistantBertDataset(args.input, max_bag_size=100, max_length=None, ignore_no_mentions=True)
+    scores = pair_scores(dataset, load_prefilter_scores(args.prefilter_preds))
+
+    if args.dev and args.dev_prefilter_preds:
+        dev_dataset = DistantBertDataset(args.dev, max_bag_size=100, max_length=None, ignore_no_mentions=True)
+        dev_scores = pair_scores(dev_dataset, load_prefilter_scores(args.dev_prefilter_preds))
+        if args.top_fraction is not None:
+            dev_threshold = top_fraction_threshold(dev_scores, args.top_fraction)
+        else:
+            dev_threshold = calibrate_threshold(dev_scores, (dev_dataset.labels > 0).any(axis=1), args.target_recall)
+        report = recall_report(dev_dataset, model, dev_scores, dev_threshold, device=args.device)
+        print(json.dumps(report, indent=1))
+        with args.output.with_name(args.output.name + '.cascade_report.json').open('w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.top_fraction is not None:
+        threshold = top_fraction_threshold(scores, args.top_fraction)
+    else:
+        threshold = dev_threshold
+
+    with args.data.open() as f:
+        data = json.load(f)
+
+    n_passed = 0
+    with args.output.open('w') as f:
+        for _, prediction in cascade_predict(dataset, model, scores, threshold, data=data, device=args.device):
+            f.write(json.dumps(prediction) + "\n")
+            n_passed += 1
+    print(f"Scored {n_passed} of {len(dataset)} pairs with PEDL (threshold {threshold})")
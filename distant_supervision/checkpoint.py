@@ -0,0 +1,232 @@
+import logging
+import math
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from transformers import WEIGHTS_NAME
+
+from .mmap_weights import save_mmap_weights
+
+logger = logging.getLogger(__name__)
+
+TRAINING_STATE_NAME = 'training_state.pt'
+CHECKPOINT_PATTERN = re.compile(r'checkpoint-(\d+)$')
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffling sampler (optionally sharded over DDP processes like DistributedSampler) whose permutation only depends
+    on seed and epoch, so that an epoch can be resumed at the exact sample at which it was interrupted.
+    position counts the samples handed to the DataLoader. Since a prefetching loader runs ahead of the training loop,
+    the trainer stores the number of consumed samples as position instead.
+    With negative_fraction, every epoch uses all positive bags and a fresh random subset of the negative bags.
+    """
+
+    def __init__(self, dataset, seed=0, rank=0, world_size=1, negative_fraction=None):
+        self.n = len(dataset)
+        self.positives = None
+        if negative_fraction is not None:
+            is_positive = (np.asarray(dataset.labels) > 0).any(axis=1)
+            self.positives = np.flatnonzero(is_positive)
+            self.negatives = np.flatnonzero(~is_positive)
+            self.n = len(self.positives) + int(round(negative_fraction * len(self.negatives)))
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.num_samples = math.ceil(self.n / world_size)
+        self.epoch = 0
+        self.position = 0
+
+    def set_epoch(self, epoch):
+        # keep the position when a resumed epoch is started again
+        if epoch != self.epoch:
+            self.position = 0
+        self.epoch = epoch
+
+    def epoch_indices(self, epoch=None):
+        epoch = self.epoch if epoch is None else epoch
+        if self.positives is None:
+            return list(range(self.n))
+        rng = np.random.RandomState(self.seed + epoch)
+        negatives = rng.choice(self.negatives, self.n - len(self.positives), replace=False)
+        return np.concatenate([self.positives, negatives]).tolist()
+
+    def permutation(self, epoch=None):
+        epoch = self.epoch if epoch is None else epoch
+        g = torch.Generator()
+        g.manual_seed(self.seed + epoch)
+        indices = self.epoch_indices(epoch)
+        return [indices[i] for i in torch.randperm(len(indices), generator=g).tolist()]
+
+    def pad(self, items):
+        # pad to a multiple of the number of processes like DistributedSampler
+        total = math.ceil(len(items) / self.world_size) * self.world_size
+        return items + items[:total - len(items)]
+
+    def shard(self, items):
+        return self.pad(items)[self.rank::self.world_size]
+
+    def __iter__(self):
+        for idx in self.shard(self.permutation())[self.position:]:
+            self.position += 1
+            yield idx
+
+    def __len__(self):
+        return self.num_samples
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'position': self.position}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.position = state['position']
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(obj):
+    """
+    Copy of all tensors in obj on the CPU, so that it is not affected by subsequent optimizer steps
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def model_state_dict(model):
+    # the BERT of the model may be wrapped in (Distributed)DataParallel
+    return {k.replace('.module.', '.'): v for k, v in model.state_dict().items()}
+
+
+def save_model(config, state_dict, output_dir):
+    """
+    Equivalent to model.save_pretrained(output_dir) plus the memory-mappable weights
+    """
+    config.save_pretrained(str(output_dir))
+    torch.save(state_dict, os.path.join(output_dir, WEIGHTS_NAME))
+    save_mmap_weights(state_dict, output_dir)
+
+
+def checkpoint_steps(output_dir):
+    steps = []
+    for path in Path(output_dir).iterdir():
+        match = CHECKPOINT_PATTERN.match(path.name)
+        if match and path.is_dir():
+            steps.append(int(match.group(1)))
+
+    return sorted(steps)
+
+
+def latest_checkpoint(output_dir):
+    """
+    Newest checkpoint in output_dir that contains a training state, or None
+    """
+    if not os.path.isdir(output_dir):
+        return None
+    for step in reversed(checkpoint_steps(output_dir)):
+        path = Path(output_dir) / f'checkpoint-{step}'
+        if (path / TRAINING_STATE_NAME).exists():
+            return path
+
+    return None
+
+
+def load_training_state(path):
+    return torch.load(Path(path) / TRAINING_STATE_NAME, map_location='cpu')
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints (a complete model directory plus the training state) in a background thread.
+    Only the best checkpoint and the keep_last most recent ones are kept (all if keep_last is None). With is_prunable,
+    older checkpoints are only removed once is_prunable(step) is true, e.g. after they were validated.
+    The best model is additionally written to output_dir itself.
+    """
+
+    def __init__(self, output_dir, keep_last=None, best_step=None, is_prunable=None):
+        self.output_dir = Path(output_dir)
+        self.keep_last = keep_last
+        self.best_step = best_step
+        self.is_prunable = is_prunable
+        self._error = None
+        # at most one snapshot waits in memory, further saves block until it is written
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def save(self, step, model, training_state, is_best=False):
+        self._raise_error()
+        # copying to the CPU is the only part that blocks training
+        state_dict = snapshot(model_state_dict(model))
+        self._queue.put((step, model.config, state_dict, snapshot(training_state), is_best))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self._error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                logger.exception("Failed to write checkpoint")
+                self._error = e
+
+    def _write(self, step, config, state_dict, training_state, is_best):
+        path = self.output_dir / f'checkpoint-{step}'
+        tmp_path = self.output_dir / f'.checkpoint-{step}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        save_model(config, state_dict, tmp_path)
+        torch.save(training_state, tmp_path / TRAINING_STATE_NAME)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        logger.info("Saved checkpoint to %s", path)
+
+        if is_best:
+            self.best_step = step
+            save_model(config, state_dict, self.output_dir)
+
+        if self.keep_last is not None:
+            steps = checkpoint_steps(self.output_dir)
+            for old_step in steps[:max(len(steps) - self.keep_last, 0)]:
+                if old_step != self.best_step and (self.is_prunable is None or self.is_prunable(old_step)):
+                    shutil.rmtree(self.output_dir / f'checkpoint-{old_step}')
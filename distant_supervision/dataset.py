@@ -3,18 +3,126 @@ import logging
 import h5py
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.nn import functional as F
+from torch.utils.data import Dataset, Subset
+
+from .checkpoint import ResumableSampler
 
 logger = logging.getLogger(__name__)
 
 
+def pack_bags(bags):
+    """
+    Concatenate the mentions of several bags, padded to the longest mention, so that they can be encoded in one pass
+    """
+    max_length = max(bag['token_ids'].shape[1] for bag in bags)
+    token_ids = torch.cat([F.pad(bag['token_ids'], (0, max_length - bag['token_ids'].shape[1])) for bag in bags])
+    attention_masks = torch.cat([F.pad(bag['attention_masks'], (0, max_length - bag['attention_masks'].shape[1]))
+                                 for bag in bags])
+    bag_sizes = [bag['token_ids'].shape[0] for bag in bags]
+
+    return token_ids, attention_masks, bag_sizes
+
+
+class TokenBudgetBatchSampler(ResumableSampler):
+    """
+    Shuffled batches of bags with at most token_budget tokens (mentions x length) each. A bag that exceeds the budget
+    on its own forms a batch by itself. Under DDP, batches instead of bags are distributed over the processes, so
+    that all processes take the same number of steps. The position counts batches.
+    With bags_per_step, syncs() tells after which batches an optimizer step is taken.
+    """
+
+    def __init__(self, dataset, token_budget, bags_per_step=None, seed=0, rank=0, world_size=1,
+                 negative_fraction=None):
+        super().__init__(dataset, seed=seed, rank=rank, world_size=world_size, negative_fraction=negative_fraction)
+        self.token_budget = token_budget
+        self.bags_per_step = bags_per_step
+        self.costs = dataset.token_counts()
+        self._batches = (None, None, None)
+
+    def epoch_batches(self, epoch):
+        # batches of all processes
+        batches = []
+        batch, cost = [], 0
+        for idx in self.permutation(epoch):
+            if batch and cost + self.costs[idx] > self.token_budget:
+                batches.append(batch)
+                batch, cost = [], 0
+            batch.append(idx)
+            cost += self.costs[idx]
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def epoch_syncs(self, batches):
+        """
+        Whether an optimizer step follows the i-th batch of each process: once bags_per_step bags per process have
+        been seen since the last step, and after the last batch of the epoch, so that no gradients are carried over
+        into the next epoch. The bags are counted over the batches that all processes train on at the same time, so
+        that all processes step together.
+        """
+        batches = self.pad(batches)
+        syncs = []
+        bags = 0
+        for i in range(0, len(batches), self.world_size):
+            bags += sum(len(batch) for batch in batches[i:i + self.world_size])
+            sync = (not self.bags_per_step or bags >= self.bags_per_step * self.world_size
+                    or i + self.world_size >= len(batches))
+            if sync:
+                bags = 0
+            syncs.append(sync)
+
+        return syncs
+
+    def num_steps(self, epoch):
+        return sum(self.epoch_syncs(self.epoch_batches(epoch)))
+
+    def _load_epoch(self):
+        if self._batches[0] != self.epoch:
+            batches = self.epoch_batches(self.epoch)
+            self._batches = (self.epoch, self.shard(batches), self.epoch_syncs(batches))
+
+    def batches(self):
+        self._load_epoch()
+        return self._batches[1]
+
+    def syncs(self):
+        self._load_epoch()
+        return self._batches[2]
+
+    def __iter__(self):
+        for batch in self.batches()[self.position:]:
+            self.position += 1
+            yield batch
+
+    def __len__(self):
+        return len(self.batches())
+
+
+def reopen_worker_files(worker_id):
+    """
+    worker_init_fn for DataLoaders with num_workers > 0 that gives each worker its own HDF5 file handles
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    if isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    for d in getattr(dataset, 'datasets', [dataset]):
+        d.reopen()
+
+
 class DistantBertDataset(Dataset):
 
     def __init__(self, path, max_bag_size=None, max_length=512, ignore_no_mentions=False, subsample_negative=1.0,
-                 has_direct=False, pair_blacklist=None, test=False):
-        self.file = h5py.File(path, 'r', driver='core')
+                 has_direct=False, pair_blacklist=None, test=False, driver='core', resample_mentions=False, seed=0):
+        self.path = path
+        self.driver = driver
+        self.file = h5py.File(path, 'r', driver=driver)
         self.max_bag_size = max_bag_size
         self.max_length = max_length
+        self.resample_mentions = resample_mentions
+        self.seed = seed
+        self.epoch = 0
         self.pairs = []
         self.entity_ids = self.file['entity_ids'][:]
         self.id2entity = self.file['id2entity'][:]
@@ -88,23 +196,62 @@ class DistantBertDataset(Dataset):
     def __len__(self):
         return len(self.pairs)
 
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def reopen(self):
+        # HDF5 handles must not be shared with forked DataLoader workers
+        self.file = h5py.File(self.path, 'r', driver=self.driver)
+
+    def mention_rows(self, idx, pair):
+        """
+        The first max_bag_size mentions of the bag or, with resample_mentions, a random subset of max_bag_size mentions
+        that only depends on the seed, the epoch and the bag
+        """
+        if self.resample_mentions and self.max_bag_size and pair in self.file['token_ids']:
+            bag_size = self.file['token_ids'][pair].shape[0]
+            if bag_size > self.max_bag_size:
+                rng = np.random.RandomState([self.seed, self.epoch, idx])
+                return np.sort(rng.choice(bag_size, self.max_bag_size, replace=False))
+
+        return slice(None, self.max_bag_size)
+
+    def token_counts(self):
+        """
+        Number of tokens (mentions x length) that the encoder sees for each bag after truncation
+        """
+        counts = np.zeros(len(self.pairs), dtype=np.int64)
+        for idx, pair in enumerate(self.pairs):
+            if pair not in self.file['token_ids']:
+                counts[idx] = 1
+                continue
+            bag_size, length = self.file['token_ids'][pair].shape
+            if self.max_bag_size:
+                bag_size = min(bag_size, self.max_bag_size)
+            if self.max_length:
+                length = min(length, self.max_length)
+            counts[idx] = bag_size * length
+
+        return counts
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
         pair = self.pairs[idx]
-        token_ids = self.file.get(f"token_ids/{pair}", np.array([[-1]]))[:]
-        attention_masks = self.file.get(f"attention_masks/{pair}", np.array([[-1]]))[:]
-        entity_pos = self.file.get(f"entity_positions/{pair}", np.array([[-1]]))[:] # bag_size x e1/e2 x start/end
-        is_direct = self.file.get(f"is_direct/{pair}", np.array([[-1]]))[:] # bag_size x e1/e2 x start/end
-        pmids = self.file.get(f"pmids/{pair}", np.array([[-1]]))[:] # bag_size x e1/e2 x start/end
+        # only the selected mentions are read from the file
+        rows = self.mention_rows(idx, pair)
+        token_ids = self.file.get(f"token_ids/{pair}", np.array([[-1]]))[rows]
+        attention_masks = self.file.get(f"attention_masks/{pair}", np.array([[-1]]))[rows]
+        entity_pos = self.file.get(f"entity_positions/{pair}", np.array([[-1]]))[rows] # bag_size x e1/e2 x start/end
+        is_direct = self.file.get(f"is_direct/{pair}", np.array([[-1]]))[rows] # bag_size x e1/e2 x start/end
+        pmids = self.file.get(f"pmids/{pair}", np.array([[-1]])) # bag_size x e1/e2 x start/end
+        pmids = pmids[rows] if isinstance(rows, np.ndarray) else pmids[:]
         labels = self.labels[idx]
         entity_ids = self.entity_ids[idx]
 
-        token_ids = token_ids[:self.max_bag_size, :self.max_length]
-        attention_masks = attention_masks[:self.max_bag_size, :self.max_length]
-        entity_pos = entity_pos[:self.max_bag_size]
-        is_direct = is_direct[:self.max_bag_size]
+        token_ids = token_ids[:, :self.max_length]
+        attention_masks = attention_masks[:, :self.max_length]
 
 
 
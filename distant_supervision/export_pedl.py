@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import torch
+from torch import nn
+
+from .dataset import DistantBertDataset
+from .model import BertForDistantSupervision, MentionEncoder, ExportedModel
+from .predict_pedl import predict
+
+
+def example_inputs(bag_size=2, length=16):
+    token_ids = torch.ones(bag_size, length, dtype=torch.long)
+    attention_masks = torch.ones(bag_size, length, dtype=torch.long)
+
+    return token_ids, attention_masks
+
+
+def export_torchscript(model, path, quantize=False):
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    encoder = MentionEncoder(model).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(encoder, example_inputs())
+    traced.save(str(path))
+
+    return path
+
+
+def export_onnx(model, path, quantize=False):
+    encoder = MentionEncoder(model).eval()
+    with torch.no_grad():
+        torch.onnx.export(encoder, example_inputs(), str(path),
+                          input_names=['token_ids', 'attention_masks'],
+                          output_names=['logits'],
+                          dynamic_axes={'token_ids': {0: 'bag_size', 1: 'length'},
+                                        'attention_masks': {0: 'bag_size', 1: 'length'},
+                                        'logits': {0: 'bag_size'}},
+                          opset_version=11)
+    if quantize:
+        try:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+        except ImportError:
+            raise ImportError("Please install onnxruntime to quantize ONNX models.")
+        quantized_path = path.with_suffix('.int8.onnx')
+        quantize_dynamic(str(path), str(quantized_path), weight_type=QuantType.QInt8)
+        path = quantized_path
+
+    return path
+
+
+def evaluate(dataset, model):
+    start = time.time()
+    scores = []
+    ap = None
+    for prediction, ap in predict(dataset, model, device='cpu'):
+        scores.append([score for _, score in prediction['labels']])
+
+    return ap, torch.tensor(scores), time.time() - start
+
+
+def accuracy_report(dataset, fp32_model, exported_model):
+    fp32_ap, fp32_scores, fp32_time = evaluate(dataset, fp32_model)
+    exported_ap, exported_scores, exported_time = evaluate(dataset, exported_model)
+
+    return {
+        'fp32_ap': fp32_ap,
+        'exported_ap': exported_ap,
+        'ap_delta': exported_ap - fp32_ap if fp32_ap is not None and exported_ap is not None else None,
+        'max_abs_score_diff': (fp32_scores - exported_scores).abs().max().item() if len(fp32_scores) else None,
+        'fp32_seconds': fp32_time,
+        'exported_seconds': exported_time,
+        'speedup': fp32_time / exported_time,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True, type=Path)
+    parser.add_argument('--output_dir', required=True, type=Path)
+    parser.add_argument('--format', choices=['torchscript', 'onnx'], default='torchscript')
+    parser.add_argument('--quantize', action='store_true',
+                        help="Additionally apply int8 dynamic quantization to all linear layers (CPU only)")
+    parser.add_argument('--dev', type=Path, default=None,
+                        help="HDF5 data set on which the exported model is compared to the FP32 checkpoint")
+
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    model = BertForDistantSupervision.from_pretrained(args.model_path)
+    model.to('cpu')
+    model.eval()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = 'model.int8' if args.quantize else 'model'
+    if args.format == 'onnx':
+        path = export_onnx(model, args.output_dir / 'model.onnx', quantize=args.quantize)
+    else:
+        path = export_torchscript(model, args.output_dir / f'{name}.pt', quantize=args.quantize)
+    print(f"Exported model to {path}")
+
+    if args.dev:
+        dataset = DistantBertDataset(
+            args.dev,
+            max_bag_size=100,
+            max_length=None,
+            ignore_no_mentions=True
+        )
+        report = accuracy_report(dataset, fp32_model=model, exported_model=ExportedModel.load(path))
+        report['path'] = str(path)
+        print(json.dumps(report, indent=1))
+        with path.with_suffix('.report.json').open('w') as f:
+            json.dump(report, f, indent=1)
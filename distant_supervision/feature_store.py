@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from .checkpoint import model_state_dict
+from .precision import autocast
+
+logger = logging.getLogger(__name__)
+
+FEATURES_NAME = 'features.bin'
+INDEX_NAME = 'index.npz'
+META_NAME = 'meta.json'
+
+
+def frozen_prefixes(config, frozen_layers):
+    prefixes = ['bert.embeddings.'] + [f'bert.encoder.layer.{i}.' for i in range(frozen_layers)]
+    if frozen_layers >= config.num_hidden_layers:
+        prefixes.append('bert.pooler.')
+
+    return tuple(prefixes)
+
+
+def freeze_bottom_layers(model, frozen_layers):
+    prefixes = frozen_prefixes(model.config, frozen_layers)
+    for name, param in model.named_parameters():
+        if name.replace('.module.', '.').startswith(prefixes):
+            param.requires_grad = False
+
+
+def frozen_fingerprint(model, frozen_layers):
+    """
+    Hash of the weights that determine the features, i.e. of the frozen layers only
+    """
+    prefixes = frozen_prefixes(model.config, frozen_layers)
+    h = hashlib.sha1(str(frozen_layers).encode())
+    for name, tensor in model_state_dict(model).items():
+        if name.startswith(prefixes):
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    return h.hexdigest()
+
+
+def mention_keys(token_ids, attention_masks):
+    keys = []
+    for tokens, mask in zip(token_ids.cpu().numpy(), attention_masks.cpu().numpy()):
+        keys.append(hashlib.sha1(tokens[mask > 0].astype(np.int64).tobytes()).digest())
+
+    return keys
+
+
+class FeatureStore:
+    """
+    Memory-mapped float16 outputs of the frozen bottom layers of a model, keyed by the token ids of each mention.
+    Hidden states are stored without padding, pooled outputs (all layers frozen) as a single row per mention.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with (self.path / META_NAME).open() as f:
+            self.meta = json.load(f)
+        self.frozen_layers = self.meta['frozen_layers']
+        self.pooled = self.meta['pooled']
+        index = np.load(self.path / INDEX_NAME)
+        self.keys = index['keys']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.features = np.memmap(self.path / FEATURES_NAME, dtype=np.float16, mode='r',
+                                  shape=(self.meta['n_rows'], self.meta['hidden_size']))
+
+    @staticmethod
+    def is_valid(path, fingerprint):
+        path = Path(path)
+        if not (path / META_NAME).exists():
+            return False
+        with (path / META_NAME).open() as f:
+            return json.load(f)['fingerprint'] == fingerprint
+
+    @classmethod
+    def build(cls, path, model, datasets, frozen_layers, device='cpu', precision='fp32'):
+        """
+        Compute the features of all mentions in datasets, unless path already contains them for the same frozen weights
+        """
+        path = Path(path)
+        fingerprint = frozen_fingerprint(model, frozen_layers)
+        if cls.is_valid(path, fingerprint):
+            logger.info(f"Using features in {path}")
+            return cls(path)
+
+        os.makedirs(path, exist_ok=True)
+        if (path / META_NAME).exists():
+            os.remove(path / META_NAME)
+        pooled = frozen_layers >= model.config.num_hidden_layers
+        model.eval()
+        model.to(device)
+        index = {}
+        n_rows = 0
+        with (path / FEATURES_NAME).open('wb') as f:
+            for dataset in datasets:
+                for bag in tqdm(DataLoader(dataset, batch_size=1), desc="Precomputing features"):
+                    token_ids = bag['token_ids'].squeeze(0)
+                    attention_masks = bag['attention_masks'].squeeze(0)
+                    if token_ids[0][0] < 0: # bag without mentions
+                        continue
+                    keys = mention_keys(token_ids, attention_masks)
+                    missing = {}
+                    for i, key in enumerate(keys):
+                        if key not in index and key not in missing:
+                            missing[key] = i
+                    if not missing:
+                        continue
+                    idx = list(missing.values())
+                    with torch.no_grad(), autocast(precision, device):
+                        features = model.frozen_features(token_ids[idx].to(device), attention_masks[idx].to(device),
+                                                         frozen_layers)
+                    features = features.float().cpu().numpy().astype(np.float16)
+                    for (key, i), feature in zip(missing.items(), features):
+                        rows = feature[None] if pooled else feature[:int(attention_masks[i].sum())]
+                        f.write(rows.tobytes())
+                        index[key] = (n_rows, len(rows))
+                        n_rows += len(rows)
+
+        keys = sorted(index)
+        np.savez(path / INDEX_NAME,
+                 keys=np.array(keys, dtype='S20'),
+                 offsets=np.array([index[k][0] for k in keys], dtype=np.int64),
+                 lengths=np.array([index[k][1] for k in keys], dtype=np.int64))
+        # written last, marks the store as complete
+        with (path / META_NAME).open('w') as f:
+            json.dump({'fingerprint': fingerprint, 'frozen_layers': frozen_layers, 'pooled': pooled,
+                       'hidden_size': model.config.hidden_size, 'n_rows': n_rows}, f)
+        logger.info(f"Stored features of {len(keys)} mentions ({n_rows} rows) in {path}")
+
+        return cls(path)
+
+    def get(self, token_ids, attention_masks):
+        keys = np.array(mention_keys(token_ids, attention_masks), dtype='S20')
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        if not np.all(self.keys[positions] == keys):
+            raise KeyError(f"Mention missing from feature store {self.path}")
+        offsets = self.offsets[positions]
+        if self.pooled:
+            return torch.from_numpy(self.features[offsets].astype(np.float32))
+
+        features = np.zeros((len(keys), token_ids.shape[1], self.features.shape[1]), dtype=np.float32)
+        for i, (offset, length) in enumerate(zip(offsets, self.lengths[positions])):
+            features[i, :length] = self.features[offset:offset + length]
+
+        return torch.from_numpy(features)
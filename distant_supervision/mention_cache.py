@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_fingerprint(model):
+    """
+    Hash of everything that determines the mention logits of a model, i.e. its weights (or its exported graph).
+    """
+    h = hashlib.sha1()
+    if hasattr(model, 'state_dict'):
+        for name, tensor in model.state_dict().items():
+            h.update(name.replace('.module.', '.').encode())
+            h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    else:
+        with open(model.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+
+    return h.hexdigest()
+
+
+class MentionCache:
+    """
+    On-disk cache of per-mention logits keyed by the checkpoint fingerprint and the mention's token ids.
+    The cache is a single sqlite file that is kept below max_size_mb by evicting the least recently used entries.
+    """
+
+    def __init__(self, path, fingerprint, max_size_mb=1024):
+        path = Path(path)
+        if path.suffix != '.sqlite':
+            os.makedirs(path, exist_ok=True)
+            path = path / 'mention_cache.sqlite'
+        self.fingerprint = fingerprint.encode()
+        self.max_size = max_size_mb * 1024 ** 2
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(str(path), timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS logits "
+                        "(key BLOB PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS logits_last_used ON logits (last_used)")
+        self.db.commit()
+        self._size = self.size()
+
+    def keys(self, token_ids, attention_masks):
+        keys = []
+        for tokens, mask in zip(token_ids.cpu().numpy(), attention_masks.cpu().numpy()):
+            h = hashlib.sha1(self.fingerprint)
+            h.update(tokens[mask > 0].astype(np.int64).tobytes())
+            keys.append(h.digest())
+
+        return keys
+
+    def get(self, keys):
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.db.execute(f"SELECT key, value FROM logits WHERE key IN ({','.join('?' * len(chunk))})",
+                                   chunk)
+            for key, value in rows:
+                found[key] = np.frombuffer(value, dtype=np.float32)
+        if found:
+            now = time.time()
+            self.db.executemany("UPDATE logits SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+            self.db.commit()
+
+        return found
+
+    def put(self, keys, logits):
+        now = time.time()
+        rows = []
+        for key, row in zip(keys, logits.detach().float().cpu().numpy()):
+            value = row.astype(np.float32).tobytes()
+            rows.append((key, value, len(key) + len(value), now))
+        self.db.executemany("INSERT OR REPLACE INTO logits VALUES (?, ?, ?, ?)", rows)
+        self.db.commit()
+        # running estimate, other processes may write to the same cache
+        self._size += sum(row[2] for row in rows)
+        if self._size > self.max_size:
+            self.evict()
+
+    def size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM logits").fetchone()[0]
+
+    def evict(self):
+        size = self._size = self.size()
+        if size <= self.max_size:
+            return
+        # evict down to 90% so that eviction does not run on every insert
+        to_free = size - int(0.9 * self.max_size)
+        cutoff = None
+        freed = 0
+        for last_used, entry_size in self.db.execute("SELECT last_used, size FROM logits ORDER BY last_used"):
+            freed += entry_size
+            cutoff = last_used
+            if freed >= to_free:
+                break
+        self.db.execute("DELETE FROM logits WHERE last_used <= ?", (cutoff,))
+        self.db.commit()
+        self._size = self.size()
+        logger.info(f"Evicted {freed} bytes from mention cache")
+
+    def mention_logits(self, model, token_ids, attention_masks):
+        keys = self.keys(token_ids, attention_masks)
+        found = self.get(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            missing_logits = model.mention_logits(token_ids[missing], attention_masks[missing])
+            self.put([keys[i] for i in missing], missing_logits)
+            n_labels = missing_logits.shape[1]
+        else:
+            n_labels = len(next(iter(found.values())))
+
+        logits = torch.empty(len(keys), n_labels, device=token_ids.device)
+        if missing:
+            logits[missing] = missing_logits.float()
+        hits = [i for i, key in enumerate(keys) if key in found]
+        if hits:
+            logits[hits] = torch.from_numpy(np.stack([found[keys[i]] for i in hits])).to(token_ids.device)
+
+        return logits
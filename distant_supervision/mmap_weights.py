@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import WEIGHTS_NAME, BertConfig, BertPreTrainedModel
+
+from .model import BertForDistantSupervision
+
+MMAP_WEIGHTS_NAME = 'pytorch_model.mmap'
+MMAP_INDEX_NAME = 'pytorch_model.mmap.json'
+ALIGNMENT = 64
+
+
+def save_mmap_weights(model, output_dir):
+    """
+    Write the state dict (of model, or model itself if it is a state dict) as one flat, uncompressed file plus a JSON
+    index, so that it can be mapped into memory without unpickling or copying.
+    """
+    output_dir = Path(output_dir)
+    state_dict = model if isinstance(model, dict) else model.state_dict()
+    index = {}
+    offset = 0
+    tensors = []
+    for name, tensor in state_dict.items():
+        name = name.replace('.module.', '.')
+        array = tensor.detach().cpu().contiguous().numpy()
+        index[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        tensors.append(array)
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = output_dir / (MMAP_WEIGHTS_NAME + '.tmp')
+    with tmp_path.open('wb') as f:
+        for array in tensors:
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % ALIGNMENT))
+    tmp_index_path = output_dir / (MMAP_INDEX_NAME + '.tmp')
+    with tmp_index_path.open('w') as f:
+        json.dump(index, f)
+    # the index is replaced last, so that it is never older than the weights it describes
+    os.replace(tmp_path, output_dir / MMAP_WEIGHTS_NAME)
+    os.replace(tmp_index_path, output_dir / MMAP_INDEX_NAME)
+
+
+def has_mmap_weights(path):
+    """
+    Whether path contains mappable weights that are at least as new as its pytorch_model.bin, which is overwritten
+    without them e.g. by save_pretrained when a model is retrained in the same directory
+    """
+    path = Path(path)
+    if not (path / MMAP_WEIGHTS_NAME).exists() or not (path / MMAP_INDEX_NAME).exists():
+        return False
+    if not (path / WEIGHTS_NAME).exists():
+        return True
+    weights_mtime = (path / WEIGHTS_NAME).stat().st_mtime
+    return min((path / name).stat().st_mtime for name in (MMAP_WEIGHTS_NAME, MMAP_INDEX_NAME)) >= weights_mtime
+
+
+@contextmanager
+def _skip_init():
+    # parameters are replaced by the mapped weights anyway, so random initialization is wasted time
+    modules = [nn.Linear, nn.Embedding, nn.LayerNorm]
+    reset_parameters = [m.reset_parameters for m in modules]
+    init_weights = BertPreTrainedModel._init_weights
+    try:
+        for m in modules:
+            m.reset_parameters = lambda self: None
+        BertPreTrainedModel._init_weights = lambda self, module: None
+        yield
+    finally:
+        for m, reset in zip(modules, reset_parameters):
+            m.reset_parameters = reset
+        BertPreTrainedModel._init_weights = init_weights
+
+
+def load_mmap_weights(path):
+    path = Path(path)
+    with (path / MMAP_INDEX_NAME).open() as f:
+        index = json.load(f)
+    # copy-on-write: pages are shared between processes until a process writes to them (e.g. during training)
+    buffer = np.memmap(path / MMAP_WEIGHTS_NAME, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for name, meta in index.items():
+        dtype = np.dtype(meta['dtype'])
+        n_bytes = int(np.prod(meta['shape'], dtype=np.int64)) * dtype.itemsize
+        array = buffer[meta['offset']:meta['offset'] + n_bytes].view(dtype).reshape(meta['shape'])
+        state_dict[name] = torch.from_numpy(array)
+
+    return state_dict
+
+
+def load_mmap_model(path, config=None, model_class=BertForDistantSupervision):
+    """
+    Zero-copy counterpart of model_class.from_pretrained(path) for checkpoints written by save_mmap_weights.
+    Weights that are missing from the checkpoint (e.g. the classifier of a plain BERT) are initialized as usual.
+    """
+    config = config or BertConfig.from_pretrained(str(path))
+    with _skip_init():
+        model = model_class(config)
+    state_dict = load_mmap_weights(path)
+
+    missing = []
+    for name, module in model.named_modules():
+        for key in list(module._parameters) + list(module._buffers):
+            full_name = f"{name}.{key}" if name else key
+            if getattr(module, key) is None:
+                continue
+            if full_name not in state_dict:
+                missing.append((module, key))
+                continue
+            if state_dict[full_name].shape != getattr(module, key).shape:
+                # like from_pretrained, e.g. for a checkpoint with a different number of labels
+                raise RuntimeError(f"Size mismatch for {full_name}: {tuple(state_dict[full_name].shape)} in {path}, "
+                                   f"{tuple(getattr(module, key).shape)} in the model")
+            if key in module._parameters:
+                param = module._parameters[key]
+                module._parameters[key] = nn.Parameter(state_dict[full_name], requires_grad=param.requires_grad)
+            else:
+                module._buffers[key] = state_dict[full_name]
+
+    for module, key in missing:
+        tensor = getattr(module, key)
+        if key == 'bias':
+            tensor.data.zero_()
+        elif isinstance(module, nn.LayerNorm):
+            tensor.data.fill_(1.0)
+        else:
+            tensor.data.normal_(mean=0.0, std=config.initializer_range)
+
+    model.eval()
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoints', nargs='+', type=Path,
+                        help="Checkpoint directories (from save_pretrained) to which the mappable weights are added")
+
+    args = parser.parse_args()
+
+    for checkpoint in args.checkpoints:
+        save_mmap_weights(BertForDistantSupervision.from_pretrained(checkpoint), checkpoint)
+        print(f"Wrote {checkpoint / MMAP_WEIGHTS_NAME}")
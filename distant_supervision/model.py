@@ -1,7 +1,8 @@
+from pathlib import Path
+
 from torch import nn
 import torch
 from transformers import BertPreTrainedModel, BertModel
-import numpy as np
 
 
 def aggregate_provenance_predictions(alphas, pmids):
@@ -16,6 +17,18 @@ def aggregate_provenance_predictions(alphas, pmids):
     return pmid_predictions
 
 
+def aggregate_mention_logits(logits):
+    alphas = torch.max(logits, dim=1)[0]
+    meta = {
+        'alphas': alphas,
+        'alphas_by_rel': logits,
+    }
+
+    x = torch.logsumexp(logits, dim=0)
+
+    return x, meta
+
+
 class BertForDistantSupervision(BertPreTrainedModel):
     def __init__(self, config, *inputs, **kwargs):
         super().__init__(config, *inputs, **kwargs)
@@ -27,20 +40,114 @@ class BertForDistantSupervision(BertPreTrainedModel):
 
         self.init_weights()
 
-    def forward(self, token_ids, attention_masks, entity_pos, **kwargs):
+    def mention_logits(self, token_ids, attention_masks):
         x = self.bert(token_ids, attention_mask=attention_masks)
         pooled_output = x[1]
 
         pooled_output = self.dropout(pooled_output)
 
-        logits = self.classifier(pooled_output)
-        alphas = torch.max(logits, dim=1)[0]
-        meta = {
-            'alphas': alphas,
-            'alphas_by_rel': logits,
-            'alphas_hist': np.histogram(alphas.detach().cpu().numpy())
-        }
+        return self.classifier(pooled_output)
+
+    def encode_layers(self, hidden_states, attention_masks, start, end):
+        bert = getattr(self.bert, 'module', self.bert)
+        extended_attention_masks = (1.0 - attention_masks[:, None, None, :].to(hidden_states.dtype)) * -10000.0
+        for layer in bert.encoder.layer[start:end]:
+            hidden_states = layer(hidden_states, attention_mask=extended_attention_masks)[0]
+
+        return hidden_states
+
+    def frozen_features(self, token_ids, attention_masks, frozen_layers):
+        """
+        Input of encoder layer frozen_layers, or the pooled output if all layers are frozen
+        """
+        bert = getattr(self.bert, 'module', self.bert)
+        hidden_states = self.encode_layers(bert.embeddings(token_ids), attention_masks, 0, frozen_layers)
+        if frozen_layers >= self.config.num_hidden_layers:
+            return bert.pooler(hidden_states)
+
+        return hidden_states
+
+    def mention_logits_from_features(self, features, attention_masks, frozen_layers):
+        bert = getattr(self.bert, 'module', self.bert)
+        if frozen_layers < self.config.num_hidden_layers:
+            hidden_states = self.encode_layers(features, attention_masks, frozen_layers, self.config.num_hidden_layers)
+            pooled_output = bert.pooler(hidden_states)
+        else:
+            pooled_output = features
+
+        pooled_output = self.dropout(pooled_output)
+
+        return self.classifier(pooled_output)
+
+    def forward(self, token_ids, attention_masks, entity_pos, bag_sizes=None, features=None, frozen_layers=None,
+                **kwargs):
+        if features is not None: # precomputed output of the frozen bottom layers
+            logits = self.mention_logits_from_features(features, attention_masks, frozen_layers)
+        else:
+            logits = self.mention_logits(token_ids, attention_masks)
+
+        if bag_sizes is not None: # mentions of several bags packed into one batch
+            return [aggregate_mention_logits(bag_logits) for bag_logits in torch.split(logits, bag_sizes)]
+        else:
+            return aggregate_mention_logits(logits)
+
+
+
+class MentionEncoder(nn.Module):
+    """
+    Traceable part of BertForDistantSupervision: maps the mentions of a bag to their per-relation logits.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, token_ids, attention_masks):
+        return self.model.mention_logits(token_ids, attention_masks)
+
+
+class ExportedModel:
+    """
+    Drop-in replacement for BertForDistantSupervision during inference that runs a TorchScript or ONNX graph
+    of the MentionEncoder produced by export_pedl.
+    """
+    def __init__(self, path, module=None, session=None):
+        self.path = Path(path)
+        self.module = module
+        self.session = session
+        self.device = 'cpu'
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        if path.suffix == '.onnx':
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError("Please install onnxruntime to run ONNX models.")
+            return cls(path, session=onnxruntime.InferenceSession(str(path)))
+        else:
+            return cls(path, module=torch.jit.load(str(path), map_location='cpu'))
+
+    def eval(self):
+        if self.module is not None:
+            self.module.eval()
+        return self
+
+    def to(self, device):
+        if self.module is not None:
+            self.module.to(device)
+            self.device = device
+        return self
+
+    def mention_logits(self, token_ids, attention_masks):
+        if self.module is not None:
+            return self.module(token_ids.to(self.device), attention_masks.to(self.device))
+        else:
+            logits = self.session.run(None, {'token_ids': token_ids.cpu().numpy(),
+                                             'attention_masks': attention_masks.cpu().numpy()})[0]
+            return torch.from_numpy(logits).to(token_ids.device)
 
-        x = torch.logsumexp(logits, dim=0)
+    def __call__(self, token_ids, attention_masks, entity_pos=None, **kwargs):
+        logits = self.mention_logits(token_ids, attention_masks)
 
-        return x, meta
+        return aggregate_mention_logits(logits)
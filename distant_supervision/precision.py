@@ -0,0 +1,54 @@
+import contextlib
+import logging
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+
+def resolve_precision(precision, device):
+    device = torch.device(device)
+    if precision == 'fp16' and device.type != 'cuda':
+        logger.warning("fp16 autocast is only supported on CUDA, using bf16 instead")
+        return 'bf16'
+    return precision
+
+
+def autocast(precision, device):
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def get_grad_scaler(precision, device):
+    # bf16 has the exponent range of fp32 and needs no loss scaling
+    return torch.cuda.amp.GradScaler(enabled=precision == 'fp16' and torch.device(device).type == 'cuda')
+
+
+class Throughput:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.bags = 0
+        self.mentions = 0
+
+    def update(self, token_ids):
+        self.bags += 1
+        self.mentions += token_ids.shape[0]
+
+    def get(self, reset=False):
+        elapsed = max(time.time() - self.start, 1e-9)
+        result = {
+            'bags_per_second': self.bags / elapsed,
+            'mentions_per_second': self.mentions / elapsed,
+        }
+        if reset:
+            self.reset()
+        return result
@@ -2,21 +2,27 @@ import argparse
 import json
 import os
 import re
-from collections import deque, defaultdict
+from collections import defaultdict
 from glob import glob
 from pathlib import Path
 import torch
 from sklearn.metrics import average_precision_score
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 import torch
 import numpy as np
 from transformers import WEIGHTS_NAME
 
 from .dataset import DistantBertDataset
-from .model import BertForDistantSupervision
+from .model import BertForDistantSupervision, ExportedModel, aggregate_mention_logits
+from .mention_cache import MentionCache, checkpoint_fingerprint
+from .prefetch import PrefetchLoader
+from .precision import PRECISIONS, autocast, resolve_precision, Throughput
+from .mmap_weights import has_mmap_weights, load_mmap_model
 
+EXPORTED_SUFFIXES = {'.pt', '.onnx'}
+AP_DISPLAY_STEPS = 1000
 
 
 def natural_sort(l):
@@ -25,17 +31,44 @@ def natural_sort(l):
     return sorted(l, key = alphanum_key)
 
 
-def predict(dataset, model, data=None):
-    model.eval()
-    dataloader = DataLoader(dataset,  batch_size=1)
-    data_it = tqdm(dataloader, desc="Predicting", total=len(dataset))
-    y_pred, y_true = deque(), deque()
+def load_model(path):
+    if Path(path).suffix in EXPORTED_SUFFIXES:
+        return ExportedModel.load(path)
+    elif has_mmap_weights(path):
+        return load_mmap_model(path)
+    else:
+        return BertForDistantSupervision.from_pretrained(path)
+
 
-    for batch in data_it:
+def predict(dataset, model, data=None, device='cuda', indices=None, mention_cache=None, precision='fp32',
+            prefetch=2, throughput=None):
+    """
+    Yields the prediction for each bag and the AP, which is None except for the last bag (and for the progress bar
+    only updated every AP_DISPLAY_STEPS bags), so that predicting stays linear in the size of the data set.
+    The next prefetch bags are loaded in the background while the current one is predicted.
+    With throughput (a precision.Throughput), the processed tokens are counted in it.
+    """
+    model.eval()
+    if indices is not None:
+        dataloader = DataLoader(Subset(dataset, indices), batch_size=1)
+    else:
+        dataloader = DataLoader(dataset,  batch_size=1)
+    data_it = tqdm(PrefetchLoader(dataloader, device, depth=prefetch), desc="Predicting", total=len(dataloader))
+    y_pred, y_true = [], []
+    throughput = throughput if throughput is not None else Throughput()
+
+    for step, batch in enumerate(data_it):
         model.eval()
-        batch = {k: v.squeeze(0).to('cuda') for k, v in batch.items()}
-        with torch.no_grad():
-            logits, meta = model(**batch)
+        batch = {k: v.squeeze(0).to(device) for k, v in batch.items()}
+        throughput.update(batch['token_ids'])
+        with torch.no_grad(), autocast(precision, device):
+            if mention_cache is not None:
+                logits, meta = aggregate_mention_logits(
+                    mention_cache.mention_logits(model, batch['token_ids'], batch['attention_masks']))
+            else:
+                logits, meta = model(**batch)
+        logits = logits.float()
+        meta = {k: v.float() if torch.is_tensor(v) else v for k, v in meta.items()}
 
         e1, e2 = batch['entity_ids']
 
@@ -65,8 +98,11 @@ def predict(dataset, model, data=None):
         if 'labels' in batch:
             y_pred.append(logits.cpu().detach().numpy())
             y_true.append(batch['labels'].cpu().numpy())
-            ap = average_precision_score(np.vstack(y_true), np.vstack(y_pred), average='micro')
-            data_it.set_postfix_str(f"ap: {ap}")
+            if step == len(dataloader) - 1 or (step + 1) % AP_DISPLAY_STEPS == 0:
+                current_ap = average_precision_score(np.vstack(y_true), np.vstack(y_pred), average='micro')
+                data_it.set_postfix_str(f"ap: {current_ap}")
+                if step == len(dataloader) - 1:
+                    ap = current_ap
 
             for i, label in enumerate(batch['labels']):
                 if label.item() > 0:
@@ -82,11 +118,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('input', type=Path)
     parser.add_argument('output',type=Path)
-    parser.add_argument('--model_path', required=True, type=Path)
+    parser.add_argument('--model_path', required=True, type=Path,
+                        help="Run directory, checkpoint directory or exported model (.pt/.onnx) from export_pedl")
     parser.add_argument('--data', required=True, type=Path)
     parser.add_argument('--device', default='cpu')
+    parser.add_argument('--mention_cache', type=Path, default=None,
+                        help="Directory of a persistent cache of mention logits that is shared across runs")
+    parser.add_argument('--mention_cache_size_mb', type=int, default=1024)
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32')
 
     args = parser.parse_args()
+    args.precision = resolve_precision(args.precision, args.device)
 
     dataset = DistantBertDataset(
         args.input,
@@ -98,24 +140,35 @@ if __name__ == '__main__':
         ignore_no_mentions=True
     )
 
-    model = BertForDistantSupervision.from_pretrained(args.model_path)
-    model.bert = nn.DataParallel(model.bert)
-    model.to(args.device)
-
     with args.data.open() as f:
         data = json.load(f)
 
-    checkpoints = list(os.path.dirname(c) for c in natural_sort(glob(str(args.model_path / '**' / WEIGHTS_NAME), recursive=True))[::-1])
+    if args.model_path.is_file():
+        checkpoints = [args.model_path]
+    else:
+        checkpoints = list(os.path.dirname(c) for c in natural_sort(glob(str(args.model_path / '**' / WEIGHTS_NAME), recursive=True))[::-1])
 
     best_ap = (None, 0)
     for checkpoint in checkpoints:
-        model = BertForDistantSupervision.from_pretrained(checkpoint)
-        model.parallel_bert = nn.DataParallel(model.bert)
+        model = load_model(checkpoint)
+        if isinstance(model, BertForDistantSupervision):
+            model.parallel_bert = nn.DataParallel(model.bert)
         model.to(args.device)
+        mention_cache = None
+        if args.mention_cache:
+            mention_cache = MentionCache(args.mention_cache, fingerprint=checkpoint_fingerprint(model) + args.precision,
+                                         max_size_mb=args.mention_cache_size_mb)
+        throughput = Throughput()
         with args.output.open('w') as f:
 
-            for prediction, ap in predict(dataset=dataset, model=model, data=data):
+            for prediction, ap in predict(dataset=dataset, model=model, data=data, device=args.device,
+                                          mention_cache=mention_cache, precision=args.precision,
+                                          throughput=throughput):
                 f.write(json.dumps(prediction) + "\n")
+            print(f"Throughput ({args.precision}): "
+                  + ", ".join(f"{k}: {v:.2f}" for k, v in throughput.get().items()))
+            if mention_cache:
+                print(f"Mention cache: {mention_cache.hits} hits, {mention_cache.misses} misses")
             if ap > best_ap[1]:
                 best_ap = (checkpoint, ap)
     print(best_ap)
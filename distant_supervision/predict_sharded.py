@@ -0,0 +1,133 @@
+import argparse
+import heapq
+import json
+import os
+import time
+from pathlib import Path
+
+import multiprocessing as mp
+import numpy as np
+import torch
+from sklearn.metrics import average_precision_score
+
+from .dataset import DistantBertDataset
+from .predict_pedl import predict, load_model
+
+
+def assign_shards(costs, n_shards):
+    """
+    Longest-processing-time-first assignment of bags to shards.
+    Each shard processes its bags largest first, so that the tail of every shard consists of cheap bags.
+    """
+    shards = [[] for _ in range(n_shards)]
+    loads = [(0, i) for i in range(n_shards)]
+    heapq.heapify(loads)
+    for idx in np.argsort(-costs, kind='stable'):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(int(idx))
+        heapq.heappush(loads, (load + int(costs[idx]), shard))
+
+    return shards
+
+
+def split_cores(cores, n_shards):
+    return [list(c) for c in np.array_split(np.array(sorted(cores)), n_shards)]
+
+
+def get_dataset(path):
+    return DistantBertDataset(
+        path,
+        max_bag_size=100,
+        max_length=None,
+        ignore_no_mentions=True
+    )
+
+
+def run_shard(shard, indices, cores, args):
+    # without pinning, cores is only the process's share of the available cores
+    if cores and not args.no_pinning:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(args.threads_per_shard or max(len(cores), 1))
+    torch.set_num_interop_threads(1)
+
+    dataset = get_dataset(args.input)
+    model = load_model(args.model_path)
+    model.to('cpu')
+
+    with args.data.open() as f:
+        data = json.load(f)
+
+    with shard_file(args.output, shard).open('w') as f:
+        for idx, (prediction, _) in zip(indices, predict(dataset=dataset, model=model, data=data, device='cpu',
+                                                         indices=indices)):
+            f.write(f"{idx}\t{json.dumps(prediction)}\n")
+
+
+def shard_file(output, shard):
+    return output.with_name(output.name + f'.shard{shard}')
+
+
+def merge_shards(output, n_shards):
+    lines = {}
+    for shard in range(n_shards):
+        with shard_file(output, shard).open() as f:
+            for line in f:
+                idx, prediction = line.split('\t', 1)
+                lines[int(idx)] = prediction
+
+    y_true, y_pred = [], []
+    with output.open('w') as f:
+        for idx in sorted(lines):
+            f.write(lines[idx])
+            prediction = json.loads(lines[idx])
+            y_pred.append([score for _, score in prediction['labels']])
+            y_true.append([rel in prediction['true_labels'] for rel, _ in prediction['labels']])
+
+    for shard in range(n_shards):
+        os.remove(shard_file(output, shard))
+
+    if y_true and np.any(y_true):
+        return average_precision_score(np.array(y_true), np.array(y_pred), average='micro')
+    else:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', type=Path)
+    parser.add_argument('output', type=Path)
+    parser.add_argument('--model_path', required=True, type=Path)
+    parser.add_argument('--data', required=True, type=Path)
+    parser.add_argument('--n_shards', default=None, type=int,
+                        help="Number of inference processes. Defaults to one per four available cores.")
+    parser.add_argument('--threads_per_shard', default=None, type=int,
+                        help="Intra-op threads per process. Defaults to the number of cores pinned to the process "
+                             "(its share of the available cores with --no_pinning).")
+    parser.add_argument('--no_pinning', action='store_true')
+
+    args = parser.parse_args()
+
+    cores = sorted(os.sched_getaffinity(0))
+    n_shards = args.n_shards or max(len(cores) // 4, 1)
+    core_sets = split_cores(cores, n_shards)
+
+    costs = get_dataset(args.input).token_counts()
+    shards = assign_shards(costs, n_shards)
+
+    start = time.time()
+    ctx = mp.get_context('spawn')
+    processes = []
+    for shard, (indices, shard_cores) in enumerate(zip(shards, core_sets)):
+        print(f"Shard {shard}: {len(indices)} bags, {sum(costs[i] for i in indices)} tokens, cores {shard_cores}")
+        p = ctx.Process(target=run_shard, args=(shard, indices, shard_cores, args))
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError(f"Inference process {p.pid} failed with exit code {p.exitcode}")
+
+    ap = merge_shards(args.output, n_shards)
+    print(f"Predicted {len(costs)} bags in {time.time() - start:.1f}s with {n_shards} processes")
+    print(f"AP: {ap}")
@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+
+import torch
+
+_DONE = object()
+
+
+def to_device(obj, device, non_blocking=False):
+    if torch.is_tensor(obj):
+        return obj.to(device, non_blocking=non_blocking)
+    if isinstance(obj, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(v, device, non_blocking) for v in obj)
+    return obj
+
+
+def pin(obj):
+    if torch.is_tensor(obj):
+        return obj.pin_memory()
+    if isinstance(obj, dict):
+        return {k: pin(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(pin(v) for v in obj)
+    return obj
+
+
+def record_stream(obj, stream):
+    # tensors copied on the side stream must not be freed before the compute stream is done with them
+    if torch.is_tensor(obj):
+        obj.record_stream(stream)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            record_stream(v, stream)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            record_stream(v, stream)
+
+
+class PrefetchLoader:
+    """
+    Iterates over a DataLoader while a background thread already loads (and on CUDA pins) the next `depth` batches.
+    On CUDA, the copy of the next batch to the device is issued on a side stream before the current batch is
+    returned, so that it overlaps with the computation. Batches are returned on the device.
+    The time that the consumer waits for batches is counted in stall_seconds.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def reset_stats(self):
+        self.stall_seconds = 0.0
+        self.n_batches = 0
+        self._stats_start = time.time()
+
+    def stats(self, reset=False):
+        elapsed = max(time.time() - self._stats_start, 1e-9)
+        result = {
+            'loader_stall_seconds': self.stall_seconds,
+            'loader_stall_fraction': self.stall_seconds / elapsed,
+        }
+        if reset:
+            self.reset_stats()
+        return result
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.loader:
+                if self.use_cuda and not getattr(self.loader, 'pin_memory', False):
+                    batch = pin(batch)
+                while not stop.is_set():
+                    try:
+                        batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            batches.put(_DONE)
+        except Exception as e:
+            batches.put(e)
+
+    def _host_batches(self):
+        if self.depth == 0:
+            yield from self.loader
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _DONE:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # also reached when the consumer stops early
+            stop.set()
+
+    def _timed_next(self, iterator):
+        start = time.time()
+        batch = next(iterator, _DONE)
+        self.stall_seconds += time.time() - start
+        return batch
+
+    def __iter__(self):
+        host_batches = self._host_batches()
+        if not self.use_cuda:
+            while True:
+                batch = self._timed_next(host_batches)
+                if batch is _DONE:
+                    return
+                self.n_batches += 1
+                yield to_device(batch, self.device)
+
+        stream = torch.cuda.Stream(device=self.device)
+
+        def copy(batch):
+            with torch.cuda.stream(stream):
+                return to_device(batch, self.device, non_blocking=True)
+
+        batch = self._timed_next(host_batches)
+        next_batch = copy(batch) if batch is not _DONE else _DONE
+        while next_batch is not _DONE:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            record_stream(batch, torch.cuda.current_stream(self.device))
+            host_batch = self._timed_next(host_batches)
+            next_batch = copy(host_batch) if host_batch is not _DONE else _DONE
+            self.n_batches += 1
+            yield batch
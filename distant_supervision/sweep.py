@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from transformers import BertConfig
+
+from .checkpoint import latest_checkpoint
+from .mmap_weights import save_mmap_weights, has_mmap_weights
+from .model import BertForDistantSupervision
+from .predict_sharded import split_cores
+
+RESULTS_NAME = 'results.json'
+
+
+def get_trials(sweep):
+    """
+    One set of train_pedl arguments per combination of the values in sweep['grid'], on top of sweep['args']
+    """
+    grid = sweep.get('grid', {})
+    names = sorted(grid)
+    trials = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        trial = dict(sweep.get('args', {}))
+        trial.update(zip(names, values))
+        trials.append((dict(zip(names, values)), trial))
+
+    return trials
+
+
+def trial_name(trial_args):
+    """
+    Name of the trial directory derived from all arguments of the trial, so that a rerun of a changed sweep neither
+    reports nor resumes trials that were trained with other arguments
+    """
+    key = json.dumps(trial_args, sort_keys=True, default=str)
+    return f"trial-{hashlib.sha1(key.encode()).hexdigest()[:10]}"
+
+
+def to_argv(trial_args):
+    argv = []
+    for name, value in trial_args.items():
+        if value is None or value is False:
+            continue
+        argv.append(f'--{name}')
+        if value is True:
+            continue
+        if isinstance(value, list):
+            argv.extend(str(v) for v in value)
+        else:
+            argv.append(str(value))
+
+    return argv
+
+
+def prepare_base_checkpoint(bert, output_dir):
+    """
+    Memory-mappable copy of the BERT weights (without classifier, which is initialized per trial), so that the trials
+    neither unpickle the checkpoint nor hold private copies of the weights they do not update.
+    """
+    if has_mmap_weights(bert):
+        return bert
+    os.makedirs(output_dir, exist_ok=True)
+    if not has_mmap_weights(output_dir):
+        model = BertForDistantSupervision.from_pretrained(bert)
+        BertConfig.from_pretrained(bert).save_pretrained(str(output_dir))
+        save_mmap_weights({k: v for k, v in model.state_dict().items() if k.startswith('bert.')}, output_dir)
+
+    return output_dir
+
+
+def get_slots(cores, cores_per_trial, memory_gb, memory_per_trial_gb):
+    n_slots = max(len(cores) // cores_per_trial, 1)
+    if memory_per_trial_gb:
+        n_slots = min(n_slots, max(int(memory_gb // memory_per_trial_gb), 1))
+
+    return split_cores(cores, n_slots)
+
+
+def start_trial(trial_args, output_dir, cores, log_path):
+    trial_args = dict(trial_args, output_dir=str(output_dir), num_threads=len(cores))
+    command = [sys.executable, '-m', 'distant_supervision.train_pedl'] + to_argv(trial_args)
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)))
+    log = open(log_path, 'w')
+
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env,
+                            preexec_fn=lambda: os.sched_setaffinity(0, cores)), log
+
+
+def read_result(output_dir):
+    path = Path(output_dir) / RESULTS_NAME
+    if not path.exists():
+        return None
+    with path.open() as f:
+        return json.load(f)
+
+
+def summary_table(results):
+    names = sorted({name for result in results for name in result['params']})
+    header = ['trial'] + names + ['best_val_ap', 'status', 'minutes']
+    rows = []
+    for result in sorted(results, key=lambda r: -(r['best_val_ap'] or 0)):
+        ap = result['best_val_ap']
+        rows.append([result['trial']] + [str(result['params'].get(name)) for name in names] +
+                    [f'{ap:.4f}' if ap is not None else '-', result['status'],
+                     f"{result['seconds'] / 60:.1f}" if result['seconds'] is not None else '-'])
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in [header] + rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run train_pedl for every combination of a grid of arguments, "
+                                                 "several trials at a time")
+    parser.add_argument('sweep', type=Path,
+                        help='JSON file with the common train_pedl arguments and the grid, e.g. '
+                             '{"args": {"bert": "...", "train": "...", "dev": "..."}, '
+                             '"grid": {"seed": [6006, 7007], "learning_rate": [3e-5, 5e-5]}}')
+    parser.add_argument('output_dir', type=Path)
+    parser.add_argument('--cores_per_trial', type=int, default=8)
+    parser.add_argument('--memory_per_trial_gb', type=float, default=None,
+                        help="Limits the number of concurrent trials to the available memory")
+    parser.add_argument('--memory_gb', type=float, default=None,
+                        help="Memory available to the sweep. Defaults to the physical memory.")
+    parser.add_argument('--poll_seconds', type=float, default=10)
+
+    args = parser.parse_args()
+
+    with args.sweep.open() as f:
+        sweep = json.load(f)
+    trials = get_trials(sweep)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # all trials read the data sets through the shared page cache instead of a private in-memory copy each
+    default_args = {'h5_driver': 'sec2', 'telemetry': 'jsonl'}
+    # one shared base checkpoint per BERT, which may also be part of the grid
+    berts = sweep.get('grid', {}).get('bert') or [sweep.get('args', {}).get('bert')]
+    base_checkpoints = {}
+    for i, bert in enumerate(berts):
+        if bert and bert not in base_checkpoints:
+            name = 'base_checkpoint' if len(berts) == 1 else f'base_checkpoint{i}'
+            base_checkpoints[bert] = str(prepare_base_checkpoint(bert, args.output_dir / name))
+
+    memory_gb = args.memory_gb or os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    free_slots = get_slots(sorted(os.sched_getaffinity(0)), args.cores_per_trial, memory_gb,
+                           args.memory_per_trial_gb)
+    print(f"{len(trials)} trials, {len(free_slots)} at a time")
+
+    results = []
+    pending = []
+    for params, trial_args in trials:
+        trial = trial_name(trial_args)
+        os.makedirs(args.output_dir / trial, exist_ok=True)
+        with (args.output_dir / trial / 'params.json').open('w') as f:
+            json.dump(trial_args, f, indent=1)
+        result = read_result(args.output_dir / trial)
+        if result is not None:
+            # finished in a previous invocation of the sweep
+            results.append({'trial': trial, 'params': params, 'best_val_ap': result['best_val_ap'],
+                            'status': 'done', 'seconds': None})
+        else:
+            trial_args = dict(default_args, **trial_args)
+            trial_args['overwrite_output_dir'] = True
+            if trial_args.get('bert') in base_checkpoints:
+                trial_args['bert'] = base_checkpoints[trial_args['bert']]
+            # continue trials that were interrupted in a previous invocation of the sweep
+            trial_args['resume'] = latest_checkpoint(args.output_dir / trial) is not None
+            pending.append((trial, params, trial_args))
+
+    running = []
+    while pending or running:
+        while pending and free_slots:
+            trial, params, trial_args = pending.pop(0)
+            cores = free_slots.pop(0)
+            process, log = start_trial(trial_args, args.output_dir / trial, cores, args.output_dir / f'{trial}.log')
+            running.append((trial, params, cores, process, log, time.time()))
+            print(f"Started {trial} on cores {cores}: {params}")
+
+        time.sleep(args.poll_seconds)
+        for item in list(running):
+            trial, params, cores, process, log, start = item
+            if process.poll() is None:
+                continue
+            running.remove(item)
+            log.close()
+            free_slots.append(cores)
+            result = read_result(args.output_dir / trial) if process.returncode == 0 else None
+            results.append({'trial': trial, 'params': params,
+                            'best_val_ap': result['best_val_ap'] if result else None,
+                            'status': 'done' if result else f'failed ({process.returncode})',
+                            'seconds': time.time() - start})
+            print(f"Finished {trial}: {results[-1]['status']}, AP {results[-1]['best_val_ap']}")
+
+    with (args.output_dir / RESULTS_NAME).open('w') as f:
+        json.dump(sorted(results, key=lambda r: r['trial']), f, indent=1)
+    print(summary_table(results))
@@ -0,0 +1,142 @@
+import json
+import logging
+import queue
+import threading
+from collections import defaultdict, deque
+
+import numpy as np
+import torch
+from sklearn.metrics import average_precision_score
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['wandb', 'jsonl', 'none']
+
+
+def _to_cpu(x):
+    return x.detach().cpu() if torch.is_tensor(x) else x
+
+
+class Telemetry:
+    """
+    Collects training metrics without forcing a device synchronization per step.
+    Values are accumulated as (detached) device tensors and moved to the host once per flush. Everything that is
+    expensive on the host (AP, histograms, writing) happens in a background thread.
+    """
+
+    def __init__(self, backend='wandb', path=None, ap_window=100):
+        self.backend = backend
+        self.path = path
+        self.on_log = None
+        self._scalars = {}
+        self._predictions = defaultdict(lambda: deque(maxlen=ap_window))
+        self._bag_predictions = defaultdict(list)
+        self._histograms = defaultdict(list)
+        self._queue = queue.Queue()
+        self._thread = None
+        if backend != 'none':
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self):
+        return self.backend != 'none'
+
+    def add_scalar(self, name, value):
+        if not self.enabled:
+            return
+        if torch.is_tensor(value):
+            value = value.detach().float()
+        total, count = self._scalars.get(name, (0, 0))
+        self._scalars[name] = (total + value, count + 1)
+
+    def add_predictions(self, name, y_true, y_pred):
+        """
+        Micro AP over the predictions of the last ap_window bags
+        """
+        if self.enabled:
+            self._predictions[name].append((y_true.detach(), y_pred.detach()))
+
+    def add_bag_predictions(self, name, y_true, y_pred):
+        """
+        Mean over bags of the AP within each bag, e.g. of the direct supervision on mention level
+        """
+        if self.enabled:
+            self._bag_predictions[name].append((y_true.detach(), y_pred.detach()))
+
+    def add_histogram(self, name, values):
+        if self.enabled:
+            self._histograms[name].append(values.detach().float())
+
+    def flush(self, step, extra=None):
+        if not self.enabled:
+            return
+        # the only device to host transfer
+        record = {
+            'step': step,
+            'extra': extra or {},
+            'scalars': {k: (_to_cpu(total), count) for k, (total, count) in self._scalars.items()},
+            'predictions': {k: [(_to_cpu(t), _to_cpu(p)) for t, p in v] for k, v in self._predictions.items()},
+            'bag_predictions': {k: [(_to_cpu(t), _to_cpu(p)) for t, p in v] for k, v in self._bag_predictions.items()},
+            'histograms': {k: torch.cat([v.flatten() for v in values]).cpu() for k, values in self._histograms.items()},
+        }
+        self._scalars = {}
+        self._bag_predictions.clear()
+        self._histograms.clear()
+        self._queue.put(record)
+
+    def log(self, values, step):
+        """
+        Log already computed host values (e.g. validation results)
+        """
+        if self.enabled:
+            self._queue.put({'step': step, 'extra': values})
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _worker(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                self._write(record['step'], self._compute(record))
+            except Exception:
+                logger.exception("Failed to log telemetry")
+
+    def _compute(self, record):
+        log_dict = dict(record['extra'])
+        for name, (total, count) in record.get('scalars', {}).items():
+            log_dict[name] = float(total) / count
+        for name, values in record.get('predictions', {}).items():
+            if values:
+                y_true = np.vstack([t.numpy() for t, _ in values])
+                y_pred = np.vstack([p.float().numpy() for _, p in values])
+                log_dict[name] = average_precision_score(y_true, y_pred, average='micro')
+        for name, values in record.get('bag_predictions', {}).items():
+            aps = []
+            for y_true, y_pred in values:
+                ap = average_precision_score(y_true.numpy(), y_pred.float().numpy().ravel(), average='micro')
+                if not np.isnan(ap):
+                    aps.append(ap)
+            log_dict[name] = np.mean(aps) if aps else None
+        for name, values in record.get('histograms', {}).items():
+            log_dict[name] = np.histogram(values.numpy())
+
+        return log_dict
+
+    def _write(self, step, log_dict):
+        if self.backend == 'wandb':
+            import wandb
+            wandb.log({k: wandb.Histogram(np_histogram=v) if isinstance(v, tuple) else v
+                       for k, v in log_dict.items()}, step=step)
+        elif self.backend == 'jsonl':
+            log_dict = {k: {'counts': v[0].tolist(), 'bins': v[1].tolist()} if isinstance(v, tuple) else v
+                        for k, v in log_dict.items()}
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'step': step, **log_dict}, default=float) + "\n")
+        if self.on_log:
+            self.on_log(log_dict)
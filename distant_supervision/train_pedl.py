@@ -1,28 +1,44 @@
 import argparse
+import contextlib
+import copy
+import datetime
 import json
 import logging
 import os
 import random
-from collections import deque
+import subprocess
+import sys
+import time
 from pathlib import Path
 
 import numpy as np
 import torch
 from transformers import BertConfig
-from sklearn.metrics import average_precision_score
 from torch import nn
 import wandb
 
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader, RandomSampler, ConcatDataset
 from tqdm import trange, tqdm
 from transformers import AdamW, WarmupLinearSchedule
 
-from .predict_pedl import predict
-from .dataset import DistantBertDataset
+from .predict_pedl import predict, load_model
+from .dataset import DistantBertDataset, TokenBudgetBatchSampler, pack_bags, reopen_worker_files
 from .model import BertForDistantSupervision
+from .mmap_weights import save_mmap_weights, has_mmap_weights, load_mmap_model
+from .checkpoint import (CheckpointManager, ResumableSampler, get_rng_state, set_rng_state, latest_checkpoint,
+                         load_training_state, model_state_dict, save_model, snapshot)
+from .feature_store import FeatureStore, freeze_bottom_layers
+from .validate import (TRAINING_DONE_NAME, stratified_subset, validate, best_validation_result, is_validated)
+from .precision import PRECISIONS, autocast, get_grad_scaler, resolve_precision, Throughput
+from .telemetry import BACKENDS, Telemetry
+from .prefetch import PrefetchLoader
 
 logger = logging.getLogger(__name__)
 
+DDP_TIMEOUT_HOURS = 6 # non-main processes wait for the full dev evaluation
+EVAL_PROCESS_TIMEOUT_SECONDS = 3600 # for the validation of the final checkpoint by the evaluation process
+
 
 def set_seed(args):
     random.seed(args.seed)
@@ -32,21 +48,7 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
-def train(args, train_dataset, model, direct_datasets=None):
-    model.train()
-    if args.n_gpu > 1 and not hasattr(model.bert, 'module'):
-        model.bert = nn.DataParallel(model.bert)
-    model.to(args.device)
-
-    if direct_datasets:
-        direct_data = ConcatDataset(direct_datasets)
-        direct_dataloader = DataLoader(direct_data, batch_size=1 ,shuffle=True)
-        direct_iterator = iter(direct_dataloader)
-    else:
-        direct_iterator = None
-    train_dataloader = DataLoader(train_dataset, batch_size=1, shuffle=True)
-    t_total = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
-
+def get_optimizer_and_scheduler(args, model, t_total):
     # Prepare optimizer and schedule (linear warmup and decay)
     no_decay = ['bias', 'LayerNorm.weight']
     optimizer_grouped_parameters = [
@@ -56,159 +58,576 @@ def train(args, train_dataset, model, direct_datasets=None):
     ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = WarmupLinearSchedule(optimizer, warmup_steps=args.warmup_steps, t_total=t_total)
-    if args.fp16:
+
+    return optimizer, scheduler
+
+
+def is_main_process(args):
+    return args.rank in (-1, 0)
+
+
+def get_dataloader(args, dataset, seed, token_budget=None, negative_fraction=None):
+    rank, world_size = (args.rank, args.world_size) if args.ddp else (0, 1)
+    if token_budget:
+        batch_sampler = TokenBudgetBatchSampler(dataset, token_budget, bags_per_step=args.bags_per_step, seed=seed,
+                                                rank=rank, world_size=world_size, negative_fraction=negative_fraction)
+        # the bags of a batch have different shapes and are packed in the training loop
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=list, num_workers=args.num_workers,
+                          worker_init_fn=reopen_worker_files)
+    else:
+        sampler = ResumableSampler(dataset, seed=seed, rank=rank, world_size=world_size,
+                                   negative_fraction=negative_fraction)
+        return DataLoader(dataset, batch_size=1, sampler=sampler, num_workers=args.num_workers,
+                          worker_init_fn=reopen_worker_files)
+
+
+def get_sampler(dataloader):
+    # the resumable (batch) sampler of a data loader from get_dataloader
+    if isinstance(dataloader.batch_sampler, TokenBudgetBatchSampler):
+        return dataloader.batch_sampler
+    return dataloader.sampler
+
+
+def maybe_no_sync(model, sync):
+    # skip the gradient all-reduce of DistributedDataParallel for all but the last backward pass before an optimizer step
+    if not sync and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def gather_rng_states(args):
+    # every process has its own dropout RNG
+    if not args.ddp:
+        return [get_rng_state()]
+    rng_states = [None] * args.world_size
+    torch.distributed.all_gather_object(rng_states, get_rng_state())
+    return rng_states
+
+
+def start_eval_process(args):
+    """
+    Validate the checkpoints written during training in a separate process (see validate.py)
+    """
+    command = [sys.executable, '-m', 'distant_supervision.validate',
+               '--output_dir', str(args.output_dir),
+               '--dev', str(args.dev),
+               '--subset_size', str(args.eval_subset_size),
+               '--seed', str(args.seed),
+               '--device', str(args.eval_device or args.device),
+               '--precision', args.precision]
+    if args.eval_budget_seconds:
+        command += ['--budget_seconds', str(args.eval_budget_seconds)]
+    if args.max_bag_size:
+        command += ['--max_bag_size', str(args.max_bag_size)]
+    if args.max_length:
+        command += ['--max_length', str(args.max_length)]
+    if args.ignore_no_mentions:
+        command.append('--ignore_no_mentions')
+
+    return subprocess.Popen(command)
+
+
+def select_final_model(args, dev_dataset, model, best_checkpoint):
+    """
+    Full dev pass over the final model and the best checkpoint of the periodic validation.
+    The better one ends up in args.output_dir.
+    """
+    final_ap = validate(dev_dataset, model, device=args.device, precision=args.precision)['ap']
+    report = {'final_ap': final_ap, 'best_checkpoint': None, 'best_checkpoint_ap': None}
+    best_model = None
+    if best_checkpoint is not None:
+        best_model = load_model(best_checkpoint)
+        best_model.to(args.device)
+        report['best_checkpoint'] = str(best_checkpoint)
+        report['best_checkpoint_ap'] = validate(dev_dataset, best_model, device=args.device,
+                                                precision=args.precision)['ap']
+
+    if best_model is None or (final_ap or 0) >= (report['best_checkpoint_ap'] or 0):
+        save_model(model.config, snapshot(model_state_dict(model)), args.output_dir)
+        report['selected'] = 'final'
+    else:
+        if Path(best_checkpoint) != Path(args.output_dir):
+            save_model(best_model.config, model_state_dict(best_model), args.output_dir)
+        report['selected'] = str(best_checkpoint)
+    torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
+
+    print(json.dumps(report, indent=1))
+    with (args.output_dir / 'final_validation.json').open('w') as f:
+        json.dump(report, f, indent=1)
+
+    return report
+
+
+def train(args, train_dataset, dev_dataset, model, direct_datasets=None, telemetry=None, training_state=None,
+          feature_store=None):
+    telemetry = telemetry or Telemetry(backend='none')
+    model.train()
+    if args.n_gpu > 1 and not args.ddp and not hasattr(model.bert, 'module'):
+        model.bert = nn.DataParallel(model.bert)
+    model.to(args.device)
+    if args.ddp:
+        train_model = DistributedDataParallel(model, device_ids=[args.local_rank] if args.n_gpu > 0 else None)
+    else:
+        train_model = model
+
+    if direct_datasets:
+        direct_data = ConcatDataset(direct_datasets)
+        direct_dataloader = get_dataloader(args, direct_data, seed=args.seed + 1)
+        direct_loader = PrefetchLoader(direct_dataloader, args.device, depth=args.prefetch)
+        direct_iterator = iter(direct_loader)
+    else:
+        direct_iterator = None
+    train_dataloader = get_dataloader(args, train_dataset, seed=args.seed, token_budget=args.token_budget,
+                                      negative_fraction=args.resample_negative)
+    train_sampler = get_sampler(train_dataloader)
+    train_loader = PrefetchLoader(train_dataloader, args.device, depth=args.prefetch)
+    if args.token_budget:
+        # the number of optimizer steps depends on the batches of each epoch
+        t_total = sum(train_sampler.num_steps(epoch) for epoch in range(int(args.num_train_epochs)))
+    else:
+        steps_per_epoch = len(train_dataloader) // args.gradient_accumulation_steps
+        t_total = steps_per_epoch * args.num_train_epochs
+
+    optimizer, scheduler = get_optimizer_and_scheduler(args, model, t_total)
+    scaler = get_grad_scaler(args.precision, args.device)
+    throughput = Throughput()
+
+    fuse_direct = args.fuse_direct and direct_iterator is not None
+    # a scaled gradient can only be unscaled (and thus clipped) once per optimizer step
+    clip_per_step = not scaler.is_enabled() and not fuse_direct and not args.token_budget
+
+    def backward(loss):
+        scaler.scale(loss).backward()
+        if clip_per_step:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+
+    def frozen_features(token_ids, attention_masks):
+        # model inputs that replace the frozen bottom layers
+        if feature_store is None:
+            return {}
+        return {'features': feature_store.get(token_ids, attention_masks).to(args.device),
+                'frozen_layers': feature_store.frozen_layers}
+
+    def set_direct_epoch(epoch):
+        direct_dataloader.sampler.set_epoch(epoch)
+        for direct_dataset in direct_datasets:
+            direct_dataset.set_epoch(epoch)
+
+    # number of consumed batches, which lags behind the sampler positions by the prefetched batches
+    train_position = 0
+    direct_position = 0
+
+    def next_direct_batch():
+        nonlocal direct_iterator, direct_position
         try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model, optimizer = amp.initialize(model, optimizer, opt_level='O1')
+            direct_batch = next(direct_iterator)
+        except StopIteration:
+            set_direct_epoch(direct_dataloader.sampler.epoch + 1)
+            direct_iterator = iter(direct_loader)
+            direct_position = 0
+            direct_batch = next(direct_iterator)
+        direct_position += 1
+        return {k: v.squeeze(0).to(args.device) for k, v in direct_batch.items()}
 
     global_step = 0
+    start_epoch = 0
     best_val_ap = 0
+    best_step = None
+    if training_state:
+        optimizer.load_state_dict(training_state['optimizer'])
+        scheduler.load_state_dict(training_state['scheduler'])
+        scaler.load_state_dict(training_state['scaler'])
+        train_sampler.load_state_dict(training_state['train_sampler'])
+        if direct_iterator:
+            direct_dataloader.sampler.load_state_dict(training_state['direct_sampler'])
+            set_direct_epoch(direct_dataloader.sampler.epoch)
+            direct_position = direct_dataloader.sampler.position
+        global_step = training_state['global_step']
+        start_epoch = training_state['epoch']
+        best_val_ap = training_state['best_val_ap']
+        best_step = training_state['best_step']
+        set_rng_state(training_state['rng'][max(args.rank, 0)])
+        logger.info(f"Resuming at epoch {start_epoch}, step {global_step}")
+
+    # with an evaluation process, checkpoints are kept until it has validated them
+    is_prunable = (lambda step: is_validated(args.output_dir, step)) if args.eval_steps and args.eval_process else None
+    checkpoints = CheckpointManager(args.output_dir, keep_last=args.save_total_limit, best_step=best_step,
+                                    is_prunable=is_prunable) if is_main_process(args) else None
+
+    def save_checkpoint(epoch, is_best=False):
+        training_state = {
+            'global_step': global_step,
+            'epoch': epoch,
+            'best_val_ap': best_val_ap,
+            'best_step': best_step,
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'scaler': scaler.state_dict(),
+            'train_sampler': dict(train_sampler.state_dict(), position=train_position),
+            'direct_sampler': dict(direct_dataloader.sampler.state_dict(),
+                                   position=direct_position) if direct_iterator else None,
+            'rng': gather_rng_states(args),
+        }
+        if checkpoints:
+            checkpoints.save(global_step, model, training_state, is_best=is_best)
+
+    eval_indices = None
+    eval_process = None
+    if args.eval_steps and is_main_process(args):
+        if os.path.exists(args.output_dir / TRAINING_DONE_NAME):
+            os.remove(args.output_dir / TRAINING_DONE_NAME)
+        if args.eval_process:
+            eval_process = start_eval_process(args)
+        else:
+            eval_indices = stratified_subset(dev_dataset, args.eval_subset_size, seed=args.seed)
+
     loss_fun = nn.BCEWithLogitsLoss()
     direct_loss_fun = nn.BCEWithLogitsLoss()
     model.zero_grad()
-    train_iterator = trange(int(args.num_train_epochs), desc="Epoch")
-    for _ in train_iterator:
-        logging_losses = []
-        logging_direct_losses = []
-        logging_distant_losses = []
-        y_pred, y_true = deque(maxlen=100), deque(maxlen=100)
-        direct_aps = []
-        epoch_iterator = enumerate(train_dataloader)
-        pbar = tqdm(total=len(train_dataloader) // args.gradient_accumulation_steps, desc="Batches")
+    train_iterator = trange(start_epoch, int(args.num_train_epochs), desc="Epoch", disable=not is_main_process(args))
+    for epoch in train_iterator:
+        train_sampler.set_epoch(epoch)
+        train_dataset.set_epoch(epoch)
+        # continues at the next batch if the epoch was interrupted
+        train_position = train_sampler.position
+        epoch_iterator = enumerate(train_loader, start=train_sampler.position)
+        if args.token_budget:
+            syncs = train_sampler.syncs()
+            pbar = tqdm(total=sum(syncs), desc="Batches", initial=sum(syncs[:train_sampler.position]),
+                        disable=not is_main_process(args))
+        else:
+            pbar = tqdm(total=steps_per_epoch, desc="Batches",
+                        initial=train_sampler.position * steps_per_epoch // max(len(train_sampler), 1),
+                        disable=not is_main_process(args))
+        telemetry.on_log = lambda log_dict: pbar.set_postfix_str(
+            f"loss: {log_dict.get('loss')}, ap: {log_dict.get('distant_ap')}, dmAP: {log_dict.get('direct_map')}")
         model.train()
-        if args.n_gpu > 1 and not hasattr(model.bert, 'module'):
-            model.bert = nn.DataParallel(model.bert)
-        model.to(args.device)
 
         for step, batch in epoch_iterator:
-            batch = {k: v.squeeze(0).to(args.device) for k, v in batch.items()}
-            logits, meta = model(**batch)
-
-            y_pred.append(logits.cpu().detach().numpy())
-            y_true.append(batch['labels'].cpu().numpy())
-
-            distant_loss = loss_fun(logits, batch['labels'].float())
-            if direct_iterator:
-                distant_loss = (1 - args.direct_weight) * distant_loss
-
-            if args.fp16:
-                with amp.scale_loss(distant_loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-                torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
+            train_position = step + 1
+            if args.token_budget:
+                sync = syncs[step]
+            else:
+                sync = (step + 1) % args.gradient_accumulation_steps == 0
+                batch = {k: v.squeeze(0).to(args.device) for k, v in batch.items()}
+                throughput.update(batch['token_ids'])
+
+            if args.token_budget:
+                # all distant bags of the batch and as many direct bags in one encoder pass
+                bags = [{k: v.to(args.device) for k, v in bag.items()} for bag in batch]
+                direct_bags = [next_direct_batch() for _ in bags] if direct_iterator else []
+                for bag in bags + direct_bags:
+                    throughput.update(bag['token_ids'])
+                token_ids, attention_masks, bag_sizes = pack_bags(bags + direct_bags)
+                with maybe_no_sync(train_model, sync):
+                    with autocast(args.precision, args.device):
+                        outputs = train_model(token_ids=token_ids, attention_masks=attention_masks, entity_pos=None,
+                                              bag_sizes=bag_sizes, **frozen_features(token_ids, attention_masks))
+                        outputs = [(logits.float(), meta) for logits, meta in outputs]
+                        outputs, direct_outputs = outputs[:len(bags)], outputs[len(bags):]
+                        # summed over bags, so that every bag has the same weight regardless of its number of mentions
+                        distant_loss = sum(loss_fun(logits, bag['labels'].float())
+                                           for (logits, _), bag in zip(outputs, bags))
+                        if direct_bags:
+                            distant_loss = (1 - args.direct_weight) * distant_loss
+                            direct_loss = sum(direct_loss_fun(meta['alphas'].float(), bag['is_direct'].float())
+                                              + loss_fun(logits, bag['labels'].float())
+                                              for (logits, meta), bag in zip(direct_outputs, direct_bags))
+                            direct_loss = args.direct_weight * direct_loss
+                        else:
+                            direct_loss = None
+                    backward(distant_loss if direct_loss is None else distant_loss + direct_loss)
+            elif fuse_direct:
+                # distant and direct bag in one encoder pass
+                direct_batch = next_direct_batch()
+                throughput.update(direct_batch['token_ids'])
+                token_ids, attention_masks, bag_sizes = pack_bags([batch, direct_batch])
+                with maybe_no_sync(train_model, sync):
+                    with autocast(args.precision, args.device):
+                        (logits, meta), (direct_logits, direct_meta) = train_model(
+                            token_ids=token_ids, attention_masks=attention_masks, entity_pos=None, bag_sizes=bag_sizes,
+                            **frozen_features(token_ids, attention_masks))
+                        logits = logits.float()
+                        distant_loss = (1 - args.direct_weight) * loss_fun(logits, batch['labels'].float())
+                        direct_loss = direct_loss_fun(direct_meta['alphas'].float(), direct_batch['is_direct'].float())
+                        direct_loss = direct_loss + loss_fun(direct_logits.float(), direct_batch['labels'].float())
+                        direct_loss = args.direct_weight * direct_loss
+                    backward(distant_loss + direct_loss)
             else:
-                distant_loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-
-            logging_distant_losses.append(distant_loss.item())
-
-            if direct_iterator:
-                try:
-                    direct_batch = next(direct_iterator)
-                except StopIteration:
-                    direct_iterator = iter(direct_dataloader)
-                    direct_batch = next(direct_iterator)
-                direct_batch = {k: v.squeeze(0).to(args.device) for k, v in direct_batch.items()}
-                direct_logits, direct_meta = model(**direct_batch)
-                direct_loss = direct_loss_fun(direct_meta['alphas'], direct_batch['is_direct'].float())
-                direct_loss = direct_loss + loss_fun(direct_logits, direct_batch['labels'].float())
-                direct_loss = args.direct_weight * direct_loss
-                logging_direct_losses.append(direct_loss.item())
-                direct_ap = average_precision_score(direct_batch['is_direct'].cpu().numpy(), direct_meta['alphas'].cpu().detach().numpy().ravel(),
-                                                    average='micro')
-                if not np.isnan(direct_ap):
-                    direct_aps.append(direct_ap)
-
-                if args.fp16:
-                    with amp.scale_loss(direct_loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
+                with maybe_no_sync(train_model, sync and not direct_iterator):
+                    with autocast(args.precision, args.device):
+                        logits, meta = train_model(**batch,
+                                                   **frozen_features(batch['token_ids'], batch['attention_masks']))
+                        logits = logits.float()
+
+                        distant_loss = loss_fun(logits, batch['labels'].float())
+                        if direct_iterator:
+                            distant_loss = (1 - args.direct_weight) * distant_loss
+
+                    backward(distant_loss)
+
+                if direct_iterator:
+                    direct_batch = next_direct_batch()
+                    throughput.update(direct_batch['token_ids'])
+                    with maybe_no_sync(train_model, sync):
+                        with autocast(args.precision, args.device):
+                            direct_logits, direct_meta = train_model(
+                                **direct_batch,
+                                **frozen_features(direct_batch['token_ids'], direct_batch['attention_masks']))
+                            direct_loss = direct_loss_fun(direct_meta['alphas'].float(), direct_batch['is_direct'].float())
+                            direct_loss = direct_loss + loss_fun(direct_logits.float(), direct_batch['labels'].float())
+                            direct_loss = args.direct_weight * direct_loss
+
+                        backward(direct_loss)
                 else:
-                    direct_loss.backward()
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                    direct_loss = None
+
+            if not args.token_budget:
+                bags, outputs = [batch], [(logits, meta)]
+                if direct_loss is not None:
+                    direct_bags, direct_outputs = [direct_batch], [(direct_logits, direct_meta)]
+                else:
+                    direct_bags, direct_outputs = [], []
+
+            for bag, (logits, meta) in zip(bags, outputs):
+                telemetry.add_predictions('distant_ap', bag['labels'], logits)
+                telemetry.add_histogram('alphas_hist', meta['alphas'])
+            for direct_bag, (_, direct_meta) in zip(direct_bags, direct_outputs):
+                telemetry.add_bag_predictions('direct_map', direct_bag['is_direct'], direct_meta['alphas'])
+            telemetry.add_scalar('distant_loss', distant_loss)
+            if direct_loss is not None:
+                telemetry.add_scalar('direct_loss', direct_loss)
+                telemetry.add_scalar('loss', distant_loss + direct_loss)
             else:
-                direct_loss = 0
+                telemetry.add_scalar('loss', distant_loss)
+
+            if sync:
+                if not clip_per_step:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()  # Update learning rate schedule
+                model.zero_grad()
+                global_step += 1
+                pbar.update(1)
+
+                if global_step % args.logging_steps == 0:
+                    stats = dict(throughput.get(reset=True), **train_loader.stats(reset=True))
+                    if direct_iterator:
+                        stats.update({f'direct_{k}': v for k, v in direct_loader.stats(reset=True).items()})
+                    telemetry.flush(global_step, extra=stats)
+
+                is_best = False
+                evaluate_now = args.eval_steps and global_step % args.eval_steps == 0
+                if evaluate_now and eval_indices is not None:
+                    result = validate(dev_dataset, model, indices=eval_indices, device=args.device,
+                                      precision=args.precision, budget_seconds=args.eval_budget_seconds)
+                    model.train()
+                    telemetry.log({'val_subset_ap': result['ap'], 'val_subset_bags': result['n_bags']},
+                                  step=global_step)
+                    if result['ap'] is not None and result['ap'] > best_val_ap:
+                        torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
+                        best_val_ap = result['ap']
+                        best_step = global_step
+                        is_best = True
+                elif evaluate_now and checkpoints:
+                    # keep the best checkpoint according to the evaluation process
+                    best_result = best_validation_result(args.output_dir)
+                    if best_result:
+                        checkpoints.best_step = best_result['step']
+                if evaluate_now or (args.save_steps and global_step % args.save_steps == 0):
+                    save_checkpoint(epoch, is_best=is_best)
+
+        if args.eval_steps:
+            # the full dev set is only used for the final model selection
+            save_checkpoint(epoch + 1)
+            continue
+
+        is_best = False
+        if is_main_process(args):
+            # Evaluation
+            val_ap = None
+            for _, val_ap in predict(dev_dataset, model, device=args.device, precision=args.precision): # predict yields prediction and current ap => exhaust iterator
+                pass
+            print()
+            print("Validation AP: " + str(val_ap))
+            print()
+            telemetry.log({'val_distant_ap': val_ap}, step=global_step)
+
+            if val_ap > best_val_ap:
+                torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
+                best_val_ap = val_ap
+                best_step = global_step
+                is_best = True
+
+        # Saving (the other processes wait here until the main process has evaluated the model)
+        save_checkpoint(epoch + 1, is_best=is_best)
+
+    if checkpoints:
+        checkpoints.close()
+        open(args.output_dir / TRAINING_DONE_NAME, 'w').close()
+    if eval_process:
+        # the evaluation process exits by itself once it has validated the final checkpoint
+        try:
+            eval_process.wait(timeout=(args.eval_budget_seconds or 0) + EVAL_PROCESS_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            logger.warning("Evaluation process did not finish the final checkpoint in time, terminating it")
+            eval_process.terminate()
+            eval_process.wait()
+
+    if args.eval_steps and is_main_process(args):
+        if eval_process:
+            best_result = best_validation_result(args.output_dir)
+            best_checkpoint = Path(best_result['checkpoint']) if best_result else None
+            if best_checkpoint and not best_checkpoint.exists():
+                best_checkpoint = None
+        else:
+            best_checkpoint = args.output_dir if best_step is not None else None
+        report = select_final_model(args, dev_dataset, model, best_checkpoint)
+        best_val_ap = max(report['final_ap'] or 0, report['best_checkpoint_ap'] or 0)
+        telemetry.log({'final_val_ap': best_val_ap}, step=global_step)
+
+    if is_main_process(args):
+        with (args.output_dir / 'results.json').open('w') as f:
+            json.dump({'best_val_ap': best_val_ap, 'global_step': global_step}, f, indent=1)
+
+
+def make_student(teacher, num_layers, hidden_size=None):
+    """
+    Build a smaller BERT from the teacher's config. If the hidden size is kept, the student is initialized with the
+    teacher's embeddings, pooler, classifier and evenly spaced encoder layers.
+    """
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = num_layers
+    if hidden_size and hidden_size != config.hidden_size:
+        config.hidden_size = hidden_size
+        config.intermediate_size = 4 * hidden_size
+        config.num_attention_heads = max(hidden_size // 64, 1)
+        return BertForDistantSupervision(config)
+
+    student = BertForDistantSupervision(config)
+    student.bert.embeddings.load_state_dict(teacher.bert.embeddings.state_dict())
+    student.bert.pooler.load_state_dict(teacher.bert.pooler.state_dict())
+    student.classifier.load_state_dict(teacher.classifier.state_dict())
+    teacher_layers = np.linspace(0, teacher.config.num_hidden_layers - 1, num_layers).round().astype(int)
+    for student_layer, teacher_layer in zip(student.bert.encoder.layer, teacher_layers):
+        student_layer.load_state_dict(teacher.bert.encoder.layer[teacher_layer].state_dict())
+
+    return student
+
+
+def timed_predict(dataset, model, device):
+    start = time.time()
+    ap = None
+    for _, ap in predict(dataset, model, device=device):
+        pass
+
+    return ap, time.time() - start
+
+
+def distill(args, train_dataset, dev_dataset, teacher, student, telemetry=None):
+    telemetry = telemetry or Telemetry(backend='none')
+    teacher.eval()
+    teacher.to(args.device)
+    student.train()
+    student.to(args.device)
+
+    train_dataloader = DataLoader(train_dataset, batch_size=1, shuffle=True)
+    t_total = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
+    optimizer, scheduler = get_optimizer_and_scheduler(args, student, t_total)
+
+    T = args.distill_temperature
+    loss_fun = nn.BCEWithLogitsLoss()
+    mention_loss_fun = nn.MSELoss()
+    global_step = 0
+    best_val_ap = 0
+    student.zero_grad()
+    for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+        pbar = tqdm(total=len(train_dataloader) // args.gradient_accumulation_steps, desc="Batches")
+        telemetry.on_log = lambda log_dict: pbar.set_postfix_str(f"loss: {log_dict.get('distill_loss')}")
+        student.train()
+        for step, batch in enumerate(train_dataloader):
+            batch = {k: v.squeeze(0).to(args.device) for k, v in batch.items()}
+            with torch.no_grad():
+                teacher_logits, teacher_meta = teacher(**batch)
+            logits, meta = student(**batch)
 
+            bag_loss = loss_fun(logits / T, torch.sigmoid(teacher_logits / T)) * T ** 2
+            mention_loss = mention_loss_fun(meta['alphas_by_rel'], teacher_meta['alphas_by_rel'])
+            label_loss = loss_fun(logits, batch['labels'].float())
+            loss = (1 - args.distill_alpha) * (bag_loss + mention_loss) + args.distill_alpha * label_loss
+
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), args.max_grad_norm)
+            telemetry.add_scalar('distill_loss', loss)
 
-            loss = (distant_loss + direct_loss).item()
-            logging_losses.append(loss)
             if (step + 1) % args.gradient_accumulation_steps == 0:
                 optimizer.step()
-                scheduler.step()  # Update learning rate schedule
-                model.zero_grad()
+                scheduler.step()
+                student.zero_grad()
                 global_step += 1
                 pbar.update(1)
+                if global_step % args.logging_steps == 0:
+                    telemetry.flush(global_step)
 
-                ap = average_precision_score(np.vstack(y_true), np.vstack(y_pred), average='micro')
-                log_dict = {
-                    'loss': np.mean(logging_losses),
-                    'direct_loss': np.mean(logging_direct_losses) if logging_direct_losses else None,
-                    'distant_loss': np.mean(logging_distant_losses),
-                    'distant_ap': ap,
-                    'direct_map': np.mean(direct_aps) if direct_aps else None,
-                }
-                for k, v in meta.items():
-                    if hasattr(v, 'detach'):
-                        v = v.detach()
-                    if hasattr(v, 'cpu'):
-                        v = v.cpu().numpy()
-                    if not args.disable_wandb:
-                        if '_hist' in k:
-                            v = wandb.Histogram(np_histogram=v)
-
-                    log_dict[k] = v
-
-                if not args.disable_wandb:
-                    wandb.log(log_dict, step=global_step)
-                pbar.set_postfix_str(f"loss: {log_dict['loss']}, ap: {ap}, dmAP: {log_dict['direct_map']}")
-                logging_losses = []
-                logging_direct_losses = []
-                logging_distant_losses = []
-                direct_aps = []
-
-        # Evaluation
-        val_ap = None
-        for _, val_ap in predict(dev_dataset, model): # predict yields prediction and current ap => exhaust iterator
-            pass
+        val_ap, _ = timed_predict(dev_dataset, student, args.device)
         print()
         print("Validation AP: " + str(val_ap))
         print()
-        if not args.disable_wandb:
-            wandb.log({'val_distant_ap': val_ap}, step=global_step)
-
-
-        # Saving
-        output_dir = os.path.join(args.output_dir, 'checkpoint-{}'.format(global_step))
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        telemetry.log({'val_distant_ap': val_ap}, step=global_step)
 
         output_dir = args.output_dir / f'checkpoint-{global_step}'
         os.makedirs(output_dir, exist_ok=True)
         logger.info("Saving model checkpoint to %s", output_dir)
-        model.to('cpu')
-        if hasattr(model.bert, 'module'):
-            model.bert = model.bert.module
-        model.save_pretrained(output_dir)
+        student.save_pretrained(output_dir)
+        save_mmap_weights(student, output_dir)
 
         if val_ap > best_val_ap:
-            model.save_pretrained(args.output_dir)
+            student.save_pretrained(args.output_dir)
+            save_mmap_weights(student, args.output_dir)
             torch.save(args, os.path.join(args.output_dir, 'training_args.bin'))
             best_val_ap = val_ap
 
+    # Compare the best student against the teacher
+    student = BertForDistantSupervision.from_pretrained(args.output_dir)
+    student.to(args.device)
+    teacher_ap, teacher_time = timed_predict(dev_dataset, teacher, args.device)
+    student_ap, student_time = timed_predict(dev_dataset, student, args.device)
+    report = {
+        'teacher_ap': teacher_ap,
+        'student_ap': student_ap,
+        'ap_retention': student_ap / teacher_ap if teacher_ap else None,
+        'teacher_seconds': teacher_time,
+        'student_seconds': student_time,
+        'speedup': teacher_time / student_time,
+        'teacher_parameters': sum(p.numel() for p in teacher.parameters()),
+        'student_parameters': sum(p.numel() for p in student.parameters()),
+    }
+    print(json.dumps(report, indent=1))
+    with (args.output_dir / 'distillation_report.json').open('w') as f:
+        json.dump(report, f, indent=1)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--bert', required=True)
+    parser.add_argument('--bert')
     parser.add_argument('--train', required=True)
     parser.add_argument('--direct_data', default=None, type=Path, nargs='*')
     parser.add_argument('--pair_blacklist', default=None, type=Path, nargs='*')
     parser.add_argument('--dev', required=True)
     parser.add_argument('--seed', default=5005, type=int)
     parser.add_argument('--no_cuda', action='store_true')
-    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help="Mixed precision with torch.autocast. fp16 uses loss scaling and falls back to bf16 on CPU.")
+    parser.add_argument('--fp16', action='store_true', help="Same as --precision fp16")
     parser.add_argument('--gradient_accumulation_steps', type=int, default=1)
+    parser.add_argument('--token_budget', type=int, default=None,
+                        help="Batch as many bags as fit into this number of tokens (mentions x length) instead of "
+                             "one bag per batch. Replaces --gradient_accumulation_steps by --bags_per_step.")
+    parser.add_argument('--bags_per_step', type=int, default=16,
+                        help="With --token_budget, take an optimizer step after this many bags (per process) and at "
+                             "the end of every epoch")
     parser.add_argument('--output_dir', type=Path, default=Path('runs/test'))
     parser.add_argument('--num_train_epochs', type=int, default=1)
     parser.add_argument('--weight_decay', type=float, default=0.0)
@@ -217,6 +636,9 @@ if __name__ == '__main__':
     parser.add_argument("--warmup_steps", default=0, type=int,
                         help="Linear warmup over warmup_steps.")
     parser.add_argument("--direct_weight", default=0.0, type=float)
+    parser.add_argument('--fuse_direct', action='store_true',
+                        help="Encode the distant and the direct bag of a step in a single forward pass and clip "
+                             "gradients once per optimizer step")
     parser.add_argument("--learning_rate", default=5e-5, type=float,
                         help="The initial learning rate for Adam.")
     parser.add_argument("--max_grad_norm", default=1.0, type=float,
@@ -225,29 +647,130 @@ if __name__ == '__main__':
     parser.add_argument("--max_length", default=None, type=int)
     parser.add_argument("--tensor_emb_size", default=200, type=int)
     parser.add_argument("--subsample_negative", default=1.0, type=float)
+    parser.add_argument("--resample_negative", default=None, type=float,
+                        help="Train on all positive bags and a new random fraction of the negative bags every epoch")
+    parser.add_argument('--resample_mentions', action='store_true',
+                        help="Draw a new random subset of --max_bag_size mentions of larger bags every epoch instead "
+                             "of always using the first ones")
     parser.add_argument('--ignore_no_mentions', action='store_true')
     parser.add_argument('--init_from', type=Path)
+    parser.add_argument('--distill_from', type=Path, default=None,
+                        help="Train a smaller student on the logits of this PEDL checkpoint instead of training --bert")
+    parser.add_argument('--student_layers', type=int, default=6)
+    parser.add_argument('--student_hidden_size', type=int, default=None)
+    parser.add_argument('--distill_temperature', type=float, default=1.0)
+    parser.add_argument('--distill_alpha', type=float, default=0.0,
+                        help="Weight of the loss against the distant labels, the rest goes to the teacher's logits")
     parser.add_argument('--overwrite_output_dir', action='store_true',
                         help="Overwrite the content of the output directory")
-    parser.add_argument('--disable_wandb', action='store_true')
+    parser.add_argument('--save_steps', type=int, default=0,
+                        help="Additionally write a resumable checkpoint every n optimizer steps")
+    parser.add_argument('--save_total_limit', type=int, default=None,
+                        help="Only keep the best and the last n checkpoints")
+    parser.add_argument('--eval_steps', type=int, default=None,
+                        help="Validate on a stratified subset of --dev every n optimizer steps instead of on the full "
+                             "dev set after every epoch. The full dev set is only used for the final model selection.")
+    parser.add_argument('--eval_subset_size', type=int, default=1000)
+    parser.add_argument('--eval_budget_seconds', type=float, default=None,
+                        help="Stop each periodic validation after this time and use the bags predicted until then")
+    parser.add_argument('--eval_process', action='store_true',
+                        help="Run the periodic validation on the latest checkpoint in a separate process")
+    parser.add_argument('--eval_device', default=None,
+                        help="Device of the validation process. Defaults to the training device.")
+    parser.add_argument('--frozen_layers', type=int, default=None,
+                        help="Freeze the embeddings and the bottom n encoder layers (all layers: also the pooler) and "
+                             "train the rest on their precomputed outputs")
+    parser.add_argument('--feature_store', type=Path, default=None,
+                        help="Directory of the precomputed features for --frozen_layers, reused if the frozen weights "
+                             "match. Defaults to features/ in the output directory.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue training from the latest checkpoint in the output directory")
+    parser.add_argument('--disable_wandb', action='store_true', help="Same as --telemetry none")
+    parser.add_argument('--telemetry', choices=BACKENDS, default='wandb',
+                        help="Where training metrics go. jsonl writes to telemetry.jsonl in the output directory.")
+    parser.add_argument('--logging_steps', type=int, default=1,
+                        help="Log metrics every n optimizer steps")
+    parser.add_argument('--wandb_watch', action='store_true', help="Log gradients and parameters with wandb.watch")
     parser.add_argument('--test', action='store_true')
+    parser.add_argument('--h5_driver', choices=['core', 'sec2'], default='core',
+                        help="core reads the data sets into memory, sec2 reads them on demand through the page cache "
+                             "that is shared between processes")
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help="DataLoader worker processes that read and collate the bags. Each worker opens the data "
+                             "sets itself, which with --h5_driver core means one in-memory copy per worker.")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="Number of batches that are loaded (and pinned) in the background while the current one "
+                             "is trained on. 0 loads them synchronously.")
+    parser.add_argument('--ddp', action='store_true',
+                        help="Multi-process training with DistributedDataParallel. Enabled automatically when "
+                             "started with torchrun and more than one process.")
+    parser.add_argument('--ddp_backend', default=None,
+                        help="Defaults to nccl on GPUs and gloo on CPUs")
+    parser.add_argument('--num_threads', default=None, type=int,
+                        help="Intra-op threads per process (torchrun sets OMP_NUM_THREADS=1 by default)")
 
     args = parser.parse_args()
-    if os.path.exists(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite_output_dir:
+    if not args.bert and not args.distill_from:
+        parser.error("Either --bert or --distill_from is required")
+
+    args.ddp = args.ddp or int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if args.ddp and args.distill_from:
+        parser.error("Distillation does not support --ddp or more than one torchrun process")
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.rank = -1
+    if args.ddp:
+        use_cuda = torch.cuda.is_available() and not args.no_cuda
+        torch.distributed.init_process_group(backend=args.ddp_backend or ('nccl' if use_cuda else 'gloo'),
+                                             timeout=datetime.timedelta(hours=DDP_TIMEOUT_HOURS))
+        args.rank = torch.distributed.get_rank()
+        args.world_size = torch.distributed.get_world_size()
+        if use_cuda:
+            torch.cuda.set_device(args.local_rank)
+            args.device = torch.device('cuda', args.local_rank)
+            args.n_gpu = 1
+        else:
+            args.device = torch.device('cpu')
+            args.n_gpu = 0
+        if args.rank > 0:
+            args.telemetry = 'none'
+    else:
+        args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+        args.n_gpu = torch.cuda.device_count()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    if args.fp16:
+        args.precision = 'fp16'
+    args.precision = resolve_precision(args.precision, args.device)
+    # all processes have to subsample the same pairs
+    set_seed(args)
+
+    if args.resume and args.distill_from:
+        parser.error("Distillation does not support --resume")
+    if args.resample_mentions and args.frozen_layers is not None:
+        parser.error("--frozen_layers only stores the features of the first --max_bag_size mentions of each bag and "
+                     "does not support --resample_mentions")
+    resume_from = latest_checkpoint(args.output_dir) if args.resume else None
+    if args.resume and not resume_from:
+        logger.warning(f"No checkpoint to resume from in {args.output_dir}, starting from scratch")
+
+    if is_main_process(args) and os.path.exists(args.output_dir) and os.listdir(args.output_dir) and not args.overwrite_output_dir and not args.resume:
         raise ValueError(
             "Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(
                 args.output_dir))
 
+    if args.disable_wandb and args.telemetry == 'wandb':
+        args.telemetry = 'none'
+    args.disable_wandb = args.telemetry != 'wandb'
     if not args.disable_wandb:
         wandb.init(project="distant_paths")
-
-    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-    args.n_gpu = torch.cuda.device_count()
+    if is_main_process(args):
+        os.makedirs(args.output_dir, exist_ok=True)
+    telemetry = Telemetry(backend=args.telemetry, path=args.output_dir / 'telemetry.jsonl')
 
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                         datefmt='%m/%d/%Y %H:%M:%S',
                         level=logging.INFO)
-    logger.warning(f"n_gpu: {args.n_gpu}, 16-bits training: {args.fp16}")
+    logger.warning(f"n_gpu: {args.n_gpu}, precision: {args.precision}, distributed rank: {args.rank}")
 
     blacklisted_pairs = set()
     if args.pair_blacklist:
@@ -259,15 +782,19 @@ if __name__ == '__main__':
         args.train,
         max_bag_size=args.max_bag_size,
         max_length=args.max_length,
+        driver=args.h5_driver,
         ignore_no_mentions=args.ignore_no_mentions,
         subsample_negative=args.subsample_negative,
         has_direct=False,
-        test=args.test
+        test=args.test,
+        resample_mentions=args.resample_mentions,
+        seed=args.seed
     )
     dev_dataset = DistantBertDataset(
         args.dev,
         max_bag_size=args.max_bag_size,
         max_length=args.max_length,
+        driver=args.h5_driver,
         ignore_no_mentions=args.ignore_no_mentions,
         has_direct=False,
         test=args.test
@@ -279,21 +806,58 @@ if __name__ == '__main__':
                 direct_data,
                 max_bag_size=args.max_bag_size,
                 max_length=args.max_length,
+                driver=args.h5_driver,
                 ignore_no_mentions=args.ignore_no_mentions,
                 has_direct=True,
                 pair_blacklist = blacklisted_pairs,
                 subsample_negative=0.0,
-                test=args.test
+                test=args.test,
+                resample_mentions=args.resample_mentions,
+                seed=args.seed
             ))
     else:
         direct_datasets = []
 
-    config = BertConfig.from_pretrained(args.bert, num_labels=train_dataset.n_classes )
-
-    model = BertForDistantSupervision.from_pretrained(args.bert,
-                                                      config=config
-                                                      )
-    if not args.disable_wandb:
-        wandb.watch(model)
-        wandb.config.update(args)
-    train(args, train_dataset=train_dataset, model=model, direct_datasets=direct_datasets)
+    if args.distill_from:
+        teacher = BertForDistantSupervision.from_pretrained(args.distill_from)
+        student = make_student(teacher, num_layers=args.student_layers, hidden_size=args.student_hidden_size)
+        if not args.disable_wandb:
+            wandb.config.update(args)
+        distill(args, train_dataset=train_dataset, dev_dataset=dev_dataset, teacher=teacher, student=student,
+                telemetry=telemetry)
+    else:
+        if resume_from:
+            model = BertForDistantSupervision.from_pretrained(resume_from)
+            training_state = load_training_state(resume_from)
+        else:
+            config = BertConfig.from_pretrained(args.bert, num_labels=train_dataset.n_classes )
+
+            if has_mmap_weights(args.bert):
+                # e.g. the shared base checkpoint of a sweep
+                model = load_mmap_model(args.bert, config=config)
+            else:
+                model = BertForDistantSupervision.from_pretrained(args.bert,
+                                                                  config=config
+                                                                  )
+            training_state = None
+        if not args.disable_wandb:
+            if args.wandb_watch:
+                wandb.watch(model)
+            wandb.config.update(args)
+        feature_store = None
+        if args.frozen_layers is not None:
+            freeze_bottom_layers(model, args.frozen_layers)
+            feature_store_path = args.feature_store or args.output_dir / 'features'
+            if is_main_process(args):
+                FeatureStore.build(feature_store_path, model, [train_dataset] + direct_datasets, args.frozen_layers,
+                                   device=args.device, precision=args.precision)
+            if args.ddp:
+                torch.distributed.barrier()
+            feature_store = FeatureStore(feature_store_path)
+        train(args, train_dataset=train_dataset, dev_dataset=dev_dataset, model=model, direct_datasets=direct_datasets,
+              telemetry=telemetry, training_state=training_state, feature_store=feature_store)
+
+    telemetry.close()
+
+    if args.ddp:
+        torch.distributed.destroy_process_group()
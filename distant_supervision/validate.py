@@ -0,0 +1,136 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from sklearn.metrics import average_precision_score
+
+from .checkpoint import latest_checkpoint
+from .dataset import DistantBertDataset
+from .predict_pedl import predict, load_model
+from .precision import PRECISIONS, resolve_precision
+
+VALIDATION_NAME = 'validation.jsonl'
+TRAINING_DONE_NAME = 'training_done'
+
+
+def stratified_subset(dataset, size, seed=0):
+    """
+    Fixed random subset of the bags with the same fraction of positive bags as the full data set. The subset is
+    shuffled, so that any prefix (e.g. the part that fits into a time budget) is stratified as well.
+    """
+    rng = np.random.RandomState(seed)
+    is_positive = (np.asarray(dataset.labels) > 0).any(axis=1)
+    positives = np.flatnonzero(is_positive)
+    negatives = np.flatnonzero(~is_positive)
+    if size >= len(is_positive):
+        indices = np.arange(len(is_positive))
+    else:
+        n_positive = min(int(round(size * len(positives) / len(is_positive))), len(positives))
+        if len(positives) > 0:
+            n_positive = max(n_positive, 1)
+        indices = np.concatenate([rng.choice(positives, n_positive, replace=False),
+                                  rng.choice(negatives, min(size - n_positive, len(negatives)), replace=False)])
+    rng.shuffle(indices)
+
+    return [int(i) for i in indices]
+
+
+def validate(dataset, model, indices=None, device='cpu', precision='fp32', budget_seconds=None):
+    """
+    Micro AP on the bags in indices (all if None). Stops after budget_seconds and reports the AP of the bags that
+    were predicted until then.
+    """
+    start = time.time()
+    y_true, y_pred = [], []
+    for prediction, _ in predict(dataset, model, device=device, indices=indices, precision=precision):
+        y_pred.append([score for _, score in prediction['labels']])
+        y_true.append([rel in prediction['true_labels'] for rel, _ in prediction['labels']])
+        if budget_seconds and time.time() - start > budget_seconds:
+            break
+
+    n_bags = len(dataset) if indices is None else len(indices)
+    return {
+        'ap': average_precision_score(np.array(y_true), np.array(y_pred), average='micro') if np.any(y_true) else None,
+        'n_bags': len(y_true),
+        'complete': len(y_true) == n_bags,
+        'seconds': time.time() - start,
+    }
+
+
+def write_validation_result(output_dir, result):
+    with (Path(output_dir) / VALIDATION_NAME).open('a') as f:
+        f.write(json.dumps(result) + "\n")
+
+
+def read_validation_results(output_dir):
+    path = Path(output_dir) / VALIDATION_NAME
+    if not path.exists():
+        return []
+    with path.open() as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def best_validation_result(output_dir):
+    results = [r for r in read_validation_results(output_dir) if r['ap'] is not None]
+    return max(results, key=lambda r: r['ap']) if results else None
+
+
+def is_validated(output_dir, step):
+    """
+    Whether the evaluation process is done with the checkpoint of step and it is not the best one so far. Since the
+    process always validates the latest checkpoint, a checkpoint older than a validated one is never validated.
+    """
+    results = read_validation_results(output_dir)
+    best_result = best_validation_result(output_dir)
+    if best_result and best_result['step'] == step:
+        return False
+    return any(r['step'] >= step for r in results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validate the latest checkpoint of a running train_pedl whenever a "
+                                                 "new one appears, until the training has finished")
+    parser.add_argument('--output_dir', required=True, type=Path, help="Output directory of train_pedl")
+    parser.add_argument('--dev', required=True)
+    parser.add_argument('--subset_size', type=int, default=1000)
+    parser.add_argument('--budget_seconds', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32')
+    parser.add_argument("--max_bag_size", default=None, type=int)
+    parser.add_argument("--max_length", default=None, type=int)
+    parser.add_argument('--ignore_no_mentions', action='store_true')
+    parser.add_argument('--poll_seconds', type=float, default=10)
+
+    args = parser.parse_args()
+    args.precision = resolve_precision(args.precision, args.device)
+
+    dataset = DistantBertDataset(args.dev, max_bag_size=args.max_bag_size, max_length=args.max_length,
+                                 ignore_no_mentions=args.ignore_no_mentions)
+    indices = stratified_subset(dataset, args.subset_size, seed=args.seed)
+
+    validated = {r['checkpoint'] for r in read_validation_results(args.output_dir)}
+    while True:
+        done = (args.output_dir / TRAINING_DONE_NAME).exists()
+        checkpoint = latest_checkpoint(args.output_dir)
+        if checkpoint and str(checkpoint) not in validated:
+            try:
+                model = load_model(checkpoint)
+            except OSError:
+                # removed by the retention policy in the meantime
+                time.sleep(args.poll_seconds)
+                continue
+            model.to(args.device)
+            result = validate(dataset, model, indices=indices, device=args.device, precision=args.precision,
+                              budget_seconds=args.budget_seconds)
+            result['checkpoint'] = str(checkpoint)
+            result['step'] = int(checkpoint.name.split('-')[-1])
+            write_validation_result(args.output_dir, result)
+            validated.add(str(checkpoint))
+            print(f"Validation AP of {checkpoint}: {result['ap']} ({result['n_bags']} bags)")
+        elif done:
+            break
+        else:
+            time.sleep(args.poll_seconds)